@@ -1,14 +1,38 @@
 import os
-from openai import OpenAI
-from fuzzywuzzy import fuzz
+import time
+import asyncio
+import logging
+from openai import OpenAI, AsyncOpenAI, APIError
 from dotenv import load_dotenv
-from typing import List, Dict
+from typing import List, Dict, AsyncIterator, Tuple, Optional
+from collections import OrderedDict, deque
 from pydantic import BaseModel
 from pydantic_ai import Agent
 
+from .similarity import is_duplicate
+from .guardrails import guardrails
+from common.llm_cache import llm_cache, llm_key
+from common.ratelimit import INTERACTIVE, limiter
+
 load_dotenv()
 
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Per-call deadline and total per-turn budget (seconds) for the async path.
+# The turn budget is the retry policy, so the SDK's own retries are disabled.
+CALL_TIMEOUT = float(os.getenv("OPENAI_CALL_TIMEOUT", "8"))
+TURN_BUDGET = float(os.getenv("OPENAI_TURN_BUDGET", "15"))
+
+# Hedged generation: race the strict retry against the primary completion
+# once the primary has been running for OPENAI_HEDGE_AFTER seconds, or
+# straight away when the session's recent rejection rate is high.
+HEDGE_ENABLED = os.getenv("OPENAI_HEDGE", "false").lower() == "true"
+HEDGE_AFTER = float(os.getenv("OPENAI_HEDGE_AFTER", "3"))
+HEDGE_REJECTION_RATE = float(os.getenv("OPENAI_HEDGE_REJECTION_RATE", "0.5"))
+
+async_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), timeout=CALL_TIMEOUT, max_retries=0)
+# Shared with Module 2; chat turns are admitted ahead of pipeline calls.
+# Waiting for admission counts against the turn budget.
+openai_limiter = limiter("openai")
 
 SYSTEM_PROMPT = """You are a product discovery assistant tasked with collecting essential factual information about a client’s product.
 
@@ -58,29 +82,8 @@ Begin by greeting the client and asking the most basic question to identify the
 # Helper Functions
 # ----------------------
 
-forbidden_phrases = [
-    "expected demand", 
-    "future demand", 
-    "market forecast", 
-    "how much future demand",
-    "how much demand", 
-    "estimate future sales",
-    "foresee any increase in demand",
-    "market size",
-    "current market size",
-    "future market size"
-]
-
 def is_forbidden(question: str) -> bool:
-    return any(phrase in question.lower() for phrase in forbidden_phrases)
-
-def is_duplicate(question: str, qa_items, threshold=80) -> bool:
-    for item in qa_items:
-        if item["role"] == "assistant":
-            similarity = fuzz.ratio(item["question"].lower(), question.lower())
-            if similarity >= threshold:
-                return True
-    return False
+    return guardrails.check(question).rejected
 
 # ----------------------
 # Pydantic Input Model
@@ -90,6 +93,7 @@ class AskInput(BaseModel):
     prompt: str
     history: List[Dict[str, str]]
     qa_items: List[Dict[str, str]]
+    session_uuid: Optional[str] = None
 
 # ----------------------
 # Main Logic
@@ -100,32 +104,301 @@ agent = Agent(
     system=SYSTEM_PROMPT
 )
 
+RETRY_PROMPT = SYSTEM_PROMPT + (
+    "\nAvoid forbidden topics like demand forecasting or vague future trends. "
+    "Do not repeat previously asked questions. Ask only useful, new questions."
+)
+
+FALLBACK_QUESTION = "Thank you. That’s all the questions we needed for now."
+
+def build_messages(system_prompt: str, history: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    messages = [{"role": "system", "content": system_prompt}]
+    messages.extend(history)
+    return messages
+
+def is_rejected(question: str, input: "AskInput") -> bool:
+    return is_forbidden(question) or is_duplicate(question, input.qa_items, session_uuid=input.session_uuid)
+
 def run_agent(input: AskInput) -> str:
     def generate(messages, temperature=0.7):
+        """A completion that passes the guardrails (only those are cached), or None."""
+        key = llm_key("gpt-4o", messages, temperature, max_tokens=150)
+        cached = llm_cache.get(key) if key else None
+        if cached is not None:
+            return None if is_rejected(cached, input) else cached
         response = client.chat.completions.create(
             model="gpt-4o",
             messages=messages,
             max_tokens=150,
             temperature=temperature
         )
-        return response.choices[0].message.content.strip()
+        question = response.choices[0].message.content.strip()
+        if is_rejected(question, input):
+            return None
+        if key:
+            llm_cache.set(key, question)
+        return question
 
-    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-    messages.extend(input.history)
+    question = generate(build_messages(SYSTEM_PROMPT, input.history), temperature=0.7)
 
-    question = generate(messages, temperature=0.7)
+    if question is None:
+        question = generate(build_messages(RETRY_PROMPT, input.history), temperature=0.3)
 
-    if is_forbidden(question) or is_duplicate(question, input.qa_items):
-        retry_prompt = SYSTEM_PROMPT + (
-            "\nAvoid forbidden topics like demand forecasting or vague future trends. "
-            "Do not repeat previously asked questions. Ask only useful, new questions."
-        )
-        retry_messages = [{"role": "system", "content": retry_prompt}]
-        retry_messages.extend(input.history)
+        if question is None:
+            question = FALLBACK_QUESTION
 
-        question = generate(retry_messages, temperature=0.3)
+    return question
 
-        if is_forbidden(question) or is_duplicate(question, input.qa_items):
-            question = "Thank you. That’s all the questions we needed for now."
+def timeout_question(qa_items) -> str:
+    """
+    A cheap question for when the turn budget runs out: the first approved
+    question marked `timeout` in the guardrails config not yet asked, so
+    the conversation can carry on instead of ending.
+    """
+    for question in guardrails.current().timeout_questions:
+        if not is_duplicate(question, qa_items):
+            return question
+    return FALLBACK_QUESTION
 
+class TurnBudget:
+    """Wall-clock budget shared by every OpenAI call made for one turn."""
+
+    def __init__(self, total: float = TURN_BUDGET, per_call: float = CALL_TIMEOUT):
+        self.deadline = time.monotonic() + total
+        self.per_call = per_call
+
+    def remaining(self) -> float:
+        return self.deadline - time.monotonic()
+
+    def next_timeout(self) -> float:
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise asyncio.TimeoutError("turn budget exhausted")
+        return min(self.per_call, remaining)
+
+async def generate_async(messages, temperature: float, budget: TurnBudget, input: AskInput) -> Optional[str]:
+    """
+    A completion that passes the guardrails, or None. Only accepted
+    completions are cached, so a rejected one is regenerated next time
+    instead of being replayed.
+    """
+    key = llm_key("gpt-4o", messages, temperature, max_tokens=150)
+    # SQLite lookups are quick but blocking; keep them off the event loop
+    cached = await asyncio.to_thread(llm_cache.get, key) if key else None
+    if cached is not None:
+        return None if is_rejected(cached, input) else cached
+
+    async with openai_limiter.slot(INTERACTIVE, timeout=budget.next_timeout()):
+        timeout = budget.next_timeout()
+        response = await asyncio.wait_for(
+            async_client.chat.completions.create(
+                model="gpt-4o",
+                messages=messages,
+                max_tokens=150,
+                temperature=temperature,
+                timeout=timeout,
+            ),
+            timeout,
+        )
+    question = response.choices[0].message.content.strip()
+    if is_rejected(question, input):
+        return None
+    if key:
+        await asyncio.to_thread(llm_cache.set, key, question)
     return question
+
+async def retry_async(input: AskInput, budget: TurnBudget) -> str:
+    """Strict retry prompt, then the budget fallback."""
+    try:
+        question = await generate_async(build_messages(RETRY_PROMPT, input.history), 0.3, budget, input)
+    except (asyncio.TimeoutError, APIError) as e:
+        logging.warning(f"Retry completion failed ({e!r}), serving fallback question")
+        return timeout_question(input.qa_items)
+
+    return question or FALLBACK_QUESTION
+
+# ----------------------
+# Hedging
+# ----------------------
+
+class RejectionTracker:
+    """Recent first-attempt rejections per session (bounded, in-process)."""
+
+    def __init__(self, window: int = 5, max_sessions: int = 2000):
+        self.window = window
+        self.max_sessions = max_sessions
+        self.sessions: "OrderedDict[str, deque]" = OrderedDict()
+
+    def record(self, session_uuid: Optional[str], rejected: bool) -> None:
+        if not session_uuid:
+            return
+        outcomes = self.sessions.pop(session_uuid, None) or deque(maxlen=self.window)
+        outcomes.append(rejected)
+        self.sessions[session_uuid] = outcomes
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+
+    def rate(self, session_uuid: Optional[str]) -> float:
+        outcomes = self.sessions.get(session_uuid) if session_uuid else None
+        return sum(outcomes) / len(outcomes) if outcomes else 0.0
+
+class HedgeStats:
+    """
+    Counters for hedged turns. `saved_seconds` is an estimate: when the
+    primary was rejected before the retry won, a serial run would only have
+    started the retry at that point. Turns where the primary was cancelled
+    still running, or won anyway, count as no saving.
+    """
+
+    def __init__(self):
+        self.turns = 0
+        self.fired = 0
+        self.primary_wins = 0
+        self.retry_wins = 0
+        self.saved_seconds = 0.0
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            "turns": self.turns,
+            "fired": self.fired,
+            "fire_rate": self.fired / self.turns if self.turns else 0.0,
+            "primary_wins": self.primary_wins,
+            "retry_wins": self.retry_wins,
+            "saved_seconds": round(self.saved_seconds, 3),
+        }
+
+rejections = RejectionTracker()
+hedge_stats = HedgeStats()
+
+async def candidate_async(input: AskInput, system_prompt: str, temperature: float, budget: TurnBudget) -> Optional[str]:
+    """A completion that passes the guardrails, or None."""
+    try:
+        return await generate_async(build_messages(system_prompt, input.history), temperature, budget, input)
+    except (asyncio.TimeoutError, APIError) as e:
+        logging.warning(f"Completion failed ({e!r}), {budget.remaining():.1f}s of turn budget left")
+        return None
+
+async def run_hedged(input: AskInput, budget: TurnBudget) -> str:
+    hedge_stats.turns += 1
+    start = time.monotonic()
+    primary = asyncio.create_task(candidate_async(input, SYSTEM_PROMPT, 0.7, budget))
+
+    if rejections.rate(input.session_uuid) < HEDGE_REJECTION_RATE:
+        await asyncio.wait({primary}, timeout=max(0.0, min(HEDGE_AFTER, budget.remaining())))
+        if primary.done():
+            question = primary.result()
+            rejections.record(input.session_uuid, question is None)
+            return question or await retry_async(input, budget)
+
+    hedge_stats.fired += 1
+    hedge_start = time.monotonic() - start
+    retry = asyncio.create_task(candidate_async(input, RETRY_PROMPT, 0.3, budget))
+    primary_rejected_at = None
+    pending = {primary, retry}
+
+    try:
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, timeout=max(0.0, budget.remaining()), return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                break
+            for task in done:
+                question = task.result()
+                if task is primary:
+                    rejections.record(input.session_uuid, question is None)
+                    if question:
+                        hedge_stats.primary_wins += 1
+                        return question
+                    primary_rejected_at = time.monotonic() - start
+                elif question:
+                    hedge_stats.retry_wins += 1
+                    if primary_rejected_at is not None:
+                        hedge_stats.saved_seconds += primary_rejected_at - hedge_start
+                    return question
+    finally:
+        for task in pending:
+            task.cancel()
+        logging.info(f"Hedged turn finished in {time.monotonic() - start:.2f}s | {hedge_stats.as_dict()}")
+
+    return timeout_question(input.qa_items)
+
+async def run_agent_async(input: AskInput, budget: TurnBudget = None, hedge: Optional[bool] = None) -> str:
+    """
+    Async run_agent with a per-call deadline and one budget covering the
+    first completion and the forbidden/duplicate retry. A call that times
+    out or errors moves on to the retry while budget remains; an exhausted
+    budget returns a fallback question immediately. With `hedge` (default
+    OPENAI_HEDGE) the retry may run concurrently with the first completion.
+    """
+    budget = budget or TurnBudget()
+    if HEDGE_ENABLED if hedge is None else hedge:
+        return await run_hedged(input, budget)
+
+    question = await candidate_async(input, SYSTEM_PROMPT, 0.7, budget)
+    rejections.record(input.session_uuid, question is None)
+    return question or await retry_async(input, budget)
+
+async def stream_completion(messages, budget: TurnBudget) -> AsyncIterator[str]:
+    # The slot is held until the stream ends, since that is when the request finishes
+    async with openai_limiter.slot(INTERACTIVE, timeout=budget.next_timeout()):
+        stream = await asyncio.wait_for(
+            async_client.chat.completions.create(
+                model="gpt-4o",
+                messages=messages,
+                max_tokens=150,
+                temperature=0.7,
+                stream=True,
+            ),
+            budget.next_timeout(),
+        )
+        chunks = stream.__aiter__()
+        try:
+            while True:
+                # Deadline per chunk: a stalled stream gives up within the budget
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), budget.next_timeout())
+                except StopAsyncIteration:
+                    return
+                if not chunk.choices:
+                    continue
+                token = chunk.choices[0].delta.content
+                if token:
+                    yield token
+        finally:
+            # A timeout, error or abandoned generator must not leave the HTTP response open
+            await stream.close()
+
+async def stream_agent(input: AskInput, budget: TurnBudget = None) -> AsyncIterator[Tuple[str, str]]:
+    """
+    Streaming variant of run_agent. Yields ("token", text) as the completion
+    arrives, then exactly one ("final", question). Guardrails run on the
+    finished text; when it is rejected the retry is not streamed and the
+    final question replaces whatever the client has shown so far. A cached
+    completion is sent as a single token.
+    """
+    budget = budget or TurnBudget()
+    messages = build_messages(SYSTEM_PROMPT, input.history)
+    key = llm_key("gpt-4o", messages, 0.7, max_tokens=150)
+    question = await asyncio.to_thread(llm_cache.get, key) if key else None
+
+    if question is not None:
+        yield "token", question
+    else:
+        parts = []
+        try:
+            async for token in stream_completion(messages, budget):
+                parts.append(token)
+                yield "token", token
+        except (asyncio.TimeoutError, APIError) as e:
+            logging.warning(f"Streamed completion failed ({e!r}), {budget.remaining():.1f}s of turn budget left")
+            parts = []
+        question = "".join(parts).strip()
+        # Cache only what passes the guardrails; a rejected stream is regenerated next time
+        if question and key and not is_rejected(question, input):
+            await asyncio.to_thread(llm_cache.set, key, question)
+
+    if not question or is_rejected(question, input):
+        question = await retry_async(input, budget)
+
+    yield "final", question
@@ -0,0 +1,128 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+from collections import Counter
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel
+
+from .similarity import QuestionIndex
+
+GUARDRAILS_PATH = os.getenv(
+    "GUARDRAILS_PATH", os.path.join(os.path.dirname(__file__), "guardrails.json")
+)
+# How often (seconds) the config file's mtime is checked for changes
+GUARDRAILS_RELOAD_INTERVAL = float(os.getenv("GUARDRAILS_RELOAD_INTERVAL", "2"))
+
+class Verdict(BaseModel):
+    rejected: bool
+    rule: Optional[str] = None          # first rule with action "reject" that fired
+    fired: List[str] = []               # every rule that fired, including "flag" rules
+    approved_similarity: float = 0.0    # best match against the approved questions
+
+class RuleSet:
+    """
+    Phrase rules compiled into a single alternation so a candidate is
+    scanned once, plus a similarity check against the approved questions.
+    """
+
+    def __init__(self, config: Dict):
+        self.actions: Dict[str, str] = {}
+        groups: Dict[str, str] = {}
+        alternatives = []
+        for i, rule in enumerate(config.get("rules", [])):
+            group = f"r{i}"
+            groups[group] = rule["name"]
+            self.actions[rule["name"]] = rule.get("action", "reject")
+            # Longest phrases first so overlapping phrases report the specific one
+            phrases = sorted((p.lower() for p in rule["phrases"]), key=len, reverse=True)
+            alternatives.append(f"(?P<{group}>{'|'.join(re.escape(p) for p in phrases)})")
+        self.groups = groups
+        self.pattern = re.compile("|".join(alternatives)) if alternatives else None
+
+        approved = config.get("approved") or {}
+        self.approved_rule = approved.get("name", "off_approved_list")
+        self.approved_threshold = float(approved.get("threshold", 0.0))
+        self.actions[self.approved_rule] = approved.get("action", "flag")
+        # Entries are a question string or {"question", "topic", "timeout"}
+        entries = [
+            entry if isinstance(entry, dict) else {"question": entry}
+            for entry in approved.get("questions", [])
+        ]
+        self.approved = QuestionIndex([entry["question"] for entry in entries])
+        # Fact sheet topic per approved question, row for row (None = untopiced)
+        self.topics: List[Optional[str]] = [entry.get("topic") for entry in entries]
+        # Cheap questions served when a turn runs out of budget, in config order
+        self.timeout_questions = [entry["question"] for entry in entries if entry.get("timeout")]
+
+    def check(self, question: str) -> Verdict:
+        fired = []
+        if self.pattern:
+            for match in self.pattern.finditer(question.lower()):
+                name = self.groups[match.lastgroup]
+                if name not in fired:
+                    fired.append(name)
+
+        similarity = self.approved.max_similarity(question) if self.approved.size else 1.0
+        if similarity < self.approved_threshold:
+            fired.append(self.approved_rule)
+
+        rule = next((name for name in fired if self.actions[name] == "reject"), None)
+        return Verdict(rejected=rule is not None, rule=rule, fired=fired, approved_similarity=similarity)
+
+class Guardrails:
+    """
+    Hot-reloadable RuleSet: the config file is re-read when its mtime
+    changes, so rules and thresholds can be tuned without a redeploy. A
+    config that fails to parse is logged and the previous rules stay live.
+    """
+
+    def __init__(self, path: str = GUARDRAILS_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.checked_at = 0.0
+        self.rules = RuleSet({})
+        self.stats: Counter = Counter()
+        self.reload()
+
+    def reload(self) -> None:
+        try:
+            mtime = os.path.getmtime(self.path)
+            if mtime == self.mtime:
+                return
+            with open(self.path, encoding="utf-8") as f:
+                rules = RuleSet(json.load(f))
+        except (OSError, ValueError, KeyError, re.error) as e:
+            logging.error(f"Guardrails config '{self.path}' not loaded: {e}")
+            return
+        self.rules, self.mtime = rules, mtime
+        logging.info(f"Guardrails loaded from '{self.path}'")
+
+    def current(self) -> RuleSet:
+        """The live RuleSet, re-reading the config at most every GUARDRAILS_RELOAD_INTERVAL."""
+        now = time.monotonic()
+        if now - self.checked_at >= GUARDRAILS_RELOAD_INTERVAL:
+            with self.lock:
+                if now - self.checked_at >= GUARDRAILS_RELOAD_INTERVAL:
+                    self.checked_at = now
+                    self.reload()
+        return self.rules
+
+    def check(self, question: str) -> Verdict:
+        verdict = self.current().check(question)
+        self.stats["checked"] += 1
+        for name in verdict.fired:
+            self.stats[name] += 1
+        if verdict.rejected:
+            self.stats["rejected"] += 1
+            logging.info(f"Guardrail '{verdict.rule}' rejected question: {question!r}")
+        return verdict
+
+guardrails = Guardrails()
+
+def guardrail_stats() -> Dict[str, int]:
+    return dict(guardrails.stats)
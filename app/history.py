@@ -0,0 +1,101 @@
+import os
+import json
+from typing import Dict, List, Tuple
+
+from .guardrails import guardrails
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("o200k_base")
+except Exception:  # tiktoken missing or its encoding files unavailable
+    _encoding = None
+
+# Turns (assistant question + user answer) sent verbatim, and the token
+# budget they must fit in. Older turns are folded into the fact sheet.
+HISTORY_TURNS = int(os.getenv("HISTORY_TURNS", "4"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1200"))
+# Per-topic cap on fact sheet text so the sheet itself stays flat
+FACT_MAX_CHARS = int(os.getenv("FACT_MAX_CHARS", "300"))
+# Minimum similarity for a question to be filed under an approved topic
+FACT_TOPIC_THRESHOLD = float(os.getenv("FACT_TOPIC_THRESHOLD", "0.3"))
+
+# Fact sheet topics come from the approved questions in the guardrails
+# config (app/guardrails.json); questions matching none of them go here
+OTHER_TOPIC = "notes"
+
+def count_tokens(text: str) -> int:
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    return len(text) // 4 + 1
+
+def split_turns(qa_items) -> List[List[Dict[str, str]]]:
+    """Chat messages grouped per turn: an assistant question and what followed it."""
+    turns: List[List[Dict[str, str]]] = []
+    for item in qa_items:
+        if item["role"] == "assistant":
+            turns.append([{"role": "assistant", "content": item["question"]}])
+        elif item["role"] == "user":
+            message = {"role": "user", "content": item["answer"]}
+            if turns:
+                turns[-1].append(message)
+            else:
+                turns.append([message])
+    return turns
+
+def topic_for(question: str) -> str:
+    rules = guardrails.current()
+    if not rules.approved.size:
+        return OTHER_TOPIC
+    similarities = rules.approved.similarities(question)
+    best = int(similarities.argmax())
+    if similarities[best] < FACT_TOPIC_THRESHOLD:
+        return OTHER_TOPIC
+    return rules.topics[best] or OTHER_TOPIC
+
+def fold_turn(fact_sheet: Dict[str, str], turn: List[Dict[str, str]]) -> None:
+    question = next((m["content"] for m in turn if m["role"] == "assistant"), "")
+    answer = " ".join(m["content"] for m in turn if m["role"] == "user").strip()
+    if not answer:
+        return
+    topic = topic_for(question) if question else OTHER_TOPIC
+    combined = f"{fact_sheet[topic]}; {answer}" if fact_sheet.get(topic) else answer
+    # Keep the most recent text when a topic overflows
+    fact_sheet[topic] = combined[-FACT_MAX_CHARS:]
+
+def fact_sheet_message(fact_sheet: Dict[str, str]) -> Dict[str, str]:
+    return {
+        "role": "system",
+        "content": "Facts already collected from earlier in this conversation (do not ask for these again):\n"
+                   + json.dumps(fact_sheet, ensure_ascii=False),
+    }
+
+def windowed_history(session: Dict, qa_items) -> Tuple[List[Dict[str, str]], Dict]:
+    """
+    Chat history for the next completion: the fact sheet plus the last
+    HISTORY_TURNS turns, trimmed further (oldest first) to fit
+    HISTORY_TOKEN_BUDGET. Only turns not folded before are folded now, and
+    the returned fields ($set on the session) persist the result so the
+    next turn picks up from there.
+    """
+    turns = split_turns(qa_items)
+    fact_sheet = dict(session.get("fact_sheet") or {})
+    folded = min(session.get("folded_turns", 0), len(turns))
+
+    keep_from = max(folded, len(turns) - HISTORY_TURNS)
+    while keep_from < len(turns) - 1:
+        tokens = sum(count_tokens(m["content"]) for turn in turns[keep_from:] for m in turn)
+        if tokens <= HISTORY_TOKEN_BUDGET:
+            break
+        keep_from += 1
+
+    for turn in turns[folded:keep_from]:
+        fold_turn(fact_sheet, turn)
+
+    history = [fact_sheet_message(fact_sheet)] if fact_sheet else []
+    for turn in turns[keep_from:]:
+        history.extend(turn)
+
+    fields = {}
+    if keep_from > folded:
+        fields = {"fact_sheet": fact_sheet, "folded_turns": keep_from}
+    return history, fields
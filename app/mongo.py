@@ -1,46 +1,196 @@
-from pymongo import MongoClient
-import certifi
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from datetime import datetime
 from typing import Optional, List, Dict
-from dotenv import load_dotenv
-import os
+import uuid
 
-# Load .env file
-load_dotenv()
+from common.db import (
+    get_async_client, CHAT_DB_NAME, SESSIONS_COLLECTION_NAME, JOBS_COLLECTION_NAME,
+    RESULTS_DB_NAME, RESULTS_COLLECTION_NAME, COMPANIES_COLLECTION_NAME,
+)
 
-# Get URI from environment
-MONGO_URL = os.getenv("MONGO_URL")
-if not MONGO_URL:
-    raise RuntimeError("MONGO_URL not found in environment variables")
+# Collections are looked up on the shared motor client (created once per
+# process by the FastAPI lifespan in main.py), so route handlers never
+# block the event loop and never open their own pools.
+def sessions_collection():
+    return get_async_client()[CHAT_DB_NAME][SESSIONS_COLLECTION_NAME]
 
-# MongoDB client
-client = MongoClient(MONGO_URL, tlsCAFile=certifi.where())
-db = client["chatbot_db"]
-collection = db["chat_sessions"]
+def jobs_collection():
+    # Same collection the worker claims from (see module2/jobs.py)
+    return get_async_client()[CHAT_DB_NAME][JOBS_COLLECTION_NAME]
 
-def store_message(session_uuid: str, question: str, answer: str, role: Optional[str] = "user") -> None:
+def results_collection():
+    # Written per application by the pipeline (module2.engine.persist_entries)
+    return get_async_client()[RESULTS_DB_NAME][RESULTS_COLLECTION_NAME]
+
+def companies_collection():
+    return get_async_client()[RESULTS_DB_NAME][COMPANIES_COLLECTION_NAME]
+
+# Per-role counters kept on the session document so routes never have to
+# scan `messages` to know how far the conversation has got.
+ROLE_COUNTERS = {
+    "assistant": "assistant_count",
+    "user": "user_count",
+}
+
+def _projection(history_limit: Optional[int]) -> Optional[Dict]:
+    """
+    None -> full document
+    0    -> everything except `messages`
+
+    There is deliberately no "last n messages" option: every caller that
+    reads the log needs all of it (the rendered log, the fact-sheet fold
+    that counts turns from the start, the duplicate check over every asked
+    question), so a sliced read would only save bytes by breaking those.
+    """
+    if history_limit is None:
+        return None
+    return {"messages": 0}
+
+async def store_message(
+    session_uuid: str,
+    question: str,
+    answer: str,
+    role: Optional[str] = "user",
+    upsert: bool = True,
+    history_limit: Optional[int] = None,
+    fields: Optional[Dict] = None,
+) -> Optional[Dict]:
+    """
+    Appends a message in a single round-trip and returns the updated session
+    (projected by `history_limit`). `fields` are $set in the same update.
+    Returns None only when `upsert` is False and the session does not exist.
+    """
+    now = datetime.now()
     message = {
         "question": question,
         "answer": answer,
-        "timestamp": datetime.now(),
+        "timestamp": now,
         "role": role
     }
 
-    if collection.find_one({"session_uuid": session_uuid}):
-        collection.update_one(
+    update = {
+        "$push": {"messages": message},
+        "$setOnInsert": {"created_at": now},
+    }
+    counter = ROLE_COUNTERS.get(role)
+    if counter:
+        update["$inc"] = {counter: 1}
+    # updated_at drives the optional session TTL (common/indexes.py)
+    update_fields = {"updated_at": now, **(fields or {})}
+    if role == "assistant":
+        update_fields["last_question"] = question
+    update["$set"] = update_fields
+
+    return await sessions_collection().find_one_and_update(
+        {"session_uuid": session_uuid},
+        update,
+        projection=_projection(history_limit),
+        upsert=upsert,
+        return_document=ReturnDocument.AFTER,
+    )
+
+async def get_chat_session(session_uuid: str, history_limit: Optional[int] = None) -> Optional[Dict]:
+    return await sessions_collection().find_one({"session_uuid": session_uuid}, _projection(history_limit))
+
+async def get_qa_history(session_uuid: str) -> List[Dict]:
+    session = await sessions_collection().find_one({"session_uuid": session_uuid}, {"messages": 1})
+    return session.get("messages", []) if session else []
+
+def current_question(session: Dict, default: str) -> str:
+    """The question the user is expected to answer next."""
+    if session.get("last_question"):
+        return session["last_question"]
+    # Sessions written before `last_question` existed
+    assistant_messages = [m for m in session.get("messages", []) if m["role"] == "assistant"]
+    return assistant_messages[-1]["question"] if assistant_messages else default
+
+def message_count(session: Dict, role: str) -> int:
+    counter = ROLE_COUNTERS[role]
+    if counter in session:
+        return session[counter]
+    # Sessions written before the counters existed
+    return sum(1 for m in session.get("messages", []) if m["role"] == role)
+
+# ------------------ Module 2 pipeline jobs ------------------
+# Fields reset when a finished job is queued again
+def _requeue_fields(now: datetime) -> Dict:
+    return {
+        "state": "queued",
+        "attempts": 0,
+        "progress": {},
+        "error": None,
+        "worker_id": None,
+        "lease_expires_at": None,
+        "finished_at": None,
+        "requeued_at": now,
+        "updated_at": now,
+    }
+
+async def enqueue_pipeline_job(session_uuid: str, session_updated_at: Optional[datetime] = None, force: bool = False) -> Dict:
+    """
+    One job per session. The first call queues it; later calls (page
+    refreshes) return it as is while it is queued or running. A finished
+    job is queued again when it failed, when the session changed after it
+    finished (`session_updated_at`), or when `force` is given; the stage
+    memoization in module2 keeps such re-runs cheap.
+    """
+    now = datetime.now()
+    rerun = [{"state": "failed"}]
+    if session_updated_at:
+        rerun.append({"state": "done", "finished_at": {"$lt": session_updated_at}})
+    if force:
+        rerun = [{"state": {"$in": ["done", "failed"]}}]
+    requeued = await jobs_collection().find_one_and_update(
+        {"session_uuid": session_uuid, "$or": rerun},
+        {"$set": _requeue_fields(now)},
+        return_document=ReturnDocument.AFTER,
+    )
+    if requeued:
+        return requeued
+
+    try:
+        return await jobs_collection().find_one_and_update(
             {"session_uuid": session_uuid},
-            {"$push": {"messages": message}}
+            {"$setOnInsert": {
+                "_id": str(uuid.uuid4()),
+                "state": "queued",
+                "attempts": 0,
+                "progress": {},
+                "created_at": now,
+                "updated_at": now,
+            }},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
         )
-    else:
-        collection.insert_one({
-            "session_uuid": session_uuid,
-            "messages": [message],
-            "created_at": datetime.now()
-        })
-
-def get_chat_session(session_uuid: str) -> Optional[Dict]:
-    return collection.find_one({"session_uuid": session_uuid})
-
-def get_qa_history(session_uuid: str) -> List[Dict]:
-    session = collection.find_one({"session_uuid": session_uuid})
-    return session.get("messages", []) if session else []
+    except DuplicateKeyError:
+        # Lost an upsert race on the unique session_uuid index
+        return await jobs_collection().find_one({"session_uuid": session_uuid})
+
+async def get_pipeline_job(job_id: str) -> Optional[Dict]:
+    return await jobs_collection().find_one({"_id": job_id})
+
+# ------------------ Module 2 results ------------------
+async def get_results_since(session_uuid: str, since: Optional[datetime] = None) -> List[Dict]:
+    """Application results for a session with their companies resolved from `company_ids`."""
+    query = {"session_uuid": session_uuid}
+    if since:
+        query["updated_at"] = {"$gt": since}
+    docs = await results_collection().find(query, {"_id": 0}).sort("updated_at", 1).to_list(length=None)
+
+    company_ids = {cid for doc in docs for cid in doc.get("company_ids", [])}
+    found = {}
+    if company_ids:
+        cursor = companies_collection().find({"_id": {"$in": list(company_ids)}}, {"applications": 0, "sessions": 0})
+        found = {company["_id"]: company async for company in cursor}
+    for doc in docs:
+        if "company_ids" in doc:
+            # company_ids are ranked; company_scores (when present) line up with them
+            scores = dict(zip(doc["company_ids"], doc.get("company_scores", [])))
+            doc["companies"] = [{**found[cid], "score": scores.get(cid)} for cid in doc["company_ids"] if cid in found]
+    return docs
+
+async def get_company_applications(place_id: str) -> List[str]:
+    """Every application a company has matched, across runs."""
+    company = await companies_collection().find_one({"_id": place_id}, {"applications": 1})
+    return company.get("applications", []) if company else []
@@ -1,61 +1,90 @@
 # app/routes.py
-import threading
-from module2 import run_search_pipeline
-
 from fastapi import APIRouter, Request, Form
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse, JSONResponse
+from fastapi.encoders import jsonable_encoder
 from fastapi.templating import Jinja2Templates
-from typing import Optional
+from typing import Optional, Set
 import uuid
+import json
+import asyncio
 
 from datetime import datetime
 
-from .mongo import get_chat_session, get_qa_history, store_message
-from .gpt import run_agent, AskInput
+from .mongo import (
+    get_chat_session, store_message, current_question, message_count,
+    enqueue_pipeline_job, get_pipeline_job, get_results_since,
+)
+from common.db import pool_stats
+from common.ratelimit import limiter_stats
+from .history import windowed_history
+from .guardrails import guardrail_stats
+from .gpt import run_agent_async, stream_agent, hedge_stats, AskInput, FALLBACK_QUESTION
 
 router = APIRouter()
 templates = Jinja2Templates(directory="templates")
 
+FIRST_QUESTION = "What is your product and what does it do?"
+
+LAST_QUESTION = "Would you like to share anything else about the product which would help us find you even better matches?"
+
+NEXT_QUESTION_PROMPT = (
+    "Based on the previous Q&A, ask the next most relevant question strictly related to understanding"
+    " the user’s product, its logistics, buyer requirements, and supply-readiness."
+    " You must cover all 3 of these before the 15th question if not already covered: Turnaround Time, Supply Capacity, Present Demand."
+    " If the user gives a vague answer like 'I don’t know', 'not sure', or leaves it blank, try rephrasing the previous question in a more specific or guided way."
+    " For example, if the question was about technical specifications and the user replied 'I don’t know', then follow up with:"
+    " 'No worries! Would you know the dimensions, materials used, weight, power requirements, or any certifications it has?'"
+    " Always give examples or typical attributes they can comment on."
+    " Do NOT ask about market trends or insights. Do NOT ask for the user’s analysis of the market."
+    " Avoid redundancy, and ask only what the user would realistically know and what helps find customers."
+)
+
+async def start_session(request: Request):
+    session_uuid = str(uuid.uuid4())
+    request.session["chat_uuid"] = session_uuid
+    session = await store_message(session_uuid, FIRST_QUESTION, "", role="assistant")
+    return session_uuid, session
+
 @router.get("/", response_class=HTMLResponse)
 async def index(request: Request):
     session_uuid = request.session.get("chat_uuid")
-    if not session_uuid:
-        session_uuid = str(uuid.uuid4())
-        request.session["chat_uuid"] = session_uuid
-        first_question = "What is your product and what does it do?"
-        store_message(session_uuid, first_question, "", role="assistant")
-    else:
-        session = get_chat_session(session_uuid)
-        if not session:
-            session_uuid = str(uuid.uuid4())
-            request.session["chat_uuid"] = session_uuid
-            first_question = "What is your product and what does it do?"
-            store_message(session_uuid, first_question, "", role="assistant")
-        else:
-            messages = session.get("messages", [])
-            assistant_messages = [m for m in messages if m["role"] == "assistant"]
-            user_messages = [m for m in messages if m["role"] == "user"]
-
-            if len(user_messages) < len(assistant_messages):
-                first_question = assistant_messages[len(user_messages)]["question"]
-            else:
-                first_question = assistant_messages[-1]["question"] if assistant_messages else "What is your product and what does it do?"
-
-    qa_log = get_qa_history(session_uuid)
+    session = await get_chat_session(session_uuid) if session_uuid else None
+    if not session:
+        session_uuid, session = await start_session(request)
 
     return templates.TemplateResponse(
         "index.html",
-        {"request": request, "question": first_question, "qa_log": qa_log},
+        {
+            "request": request,
+            "question": current_question(session, FIRST_QUESTION),
+            "qa_log": session.get("messages", []),
+        },
     )
 
-def build_history(qa_items):
-    history = []
-    for item in qa_items:
-        if item["role"] == "assistant":
-            history.append({"role": "assistant", "content": item["question"]})
-        elif item["role"] == "user":
-            history.append({"role": "user", "content": item["answer"]})
-    return history
+async def store_answer(request: Request, session_uuid: str, user_answer: str):
+    session = await store_message(session_uuid, "", user_answer, role="user", upsert=False)
+    if not session:
+        session_uuid, _ = await start_session(request)
+        session = await store_message(session_uuid, "", user_answer, role="user")
+    return session_uuid, session
+
+def next_question_input(session_uuid: str, session):
+    """
+    AskInput for the next question, plus the session fields to persist with
+    it (the updated fact sheet once older turns fall out of the window).
+    """
+    qa_log = session.get("messages", [])
+    # Ensure all timestamps in qa_log are strings
+    for item in qa_log:
+        if isinstance(item.get("timestamp"), datetime):
+            item["timestamp"] = item["timestamp"].isoformat()
+    history, fields = windowed_history(session, qa_log)
+    return AskInput(
+        prompt=NEXT_QUESTION_PROMPT,
+        history=history,
+        qa_items=qa_log,
+        session_uuid=session_uuid,
+    ), fields
 
 @router.post("/", response_class=HTMLResponse)
 async def post_answer(
@@ -67,99 +96,219 @@ async def post_answer(
     if not session_uuid:
         return RedirectResponse(url="/", status_code=303)
 
-    session = get_chat_session(session_uuid)
-    if not session:
-        session_uuid = str(uuid.uuid4())
-        request.session["chat_uuid"] = session_uuid
-        store_message(session_uuid, "What is your product and what does it do?", "", role="assistant")
-        session = get_chat_session(session_uuid)
-
-    qa_log = get_qa_history(session_uuid)
-
     # ✅ End conversation if button clicked
     if end_conversation == "true":
-        store_message(session_uuid, "", "Conversation ended by user.", role="system")
+        await store_message(session_uuid, "", "Conversation ended by user.", role="system", history_limit=0)
         return RedirectResponse(url="/complete", status_code=303)
 
     user_answer = answer.strip() if answer else ""
 
     if user_answer == "":
-        assistant_messages = [m for m in qa_log if m["role"] == "assistant"]
-        user_messages = [m for m in qa_log if m["role"] == "user"]
-        if len(user_messages) < len(assistant_messages):
-            last_question = assistant_messages[len(user_messages)]["question"]
-        else:
-            last_question = "What is your product and what does it do?"
+        session = await get_chat_session(session_uuid)
+        if not session:
+            session_uuid, session = await start_session(request)
         return templates.TemplateResponse(
             "index.html",
-            {"request": request, "question": last_question, "qa_log": qa_log},
+            {
+                "request": request,
+                "question": current_question(session, FIRST_QUESTION),
+                "qa_log": session.get("messages", []),
+            },
         )
 
-    # ✅ Store user response
-    store_message(session_uuid, "", user_answer, role="user")
+    # ✅ Store user response (round-trip 1: returns the updated session)
+    session_uuid, session = await store_answer(request, session_uuid, user_answer)
+    qa_log = session.get("messages", [])
 
-    # ✅ Refresh QA log and history
-    qa_log = get_qa_history(session_uuid)
-    history = build_history(qa_log)
-
-    assistant_questions_count = len([m for m in qa_log if m["role"] == "assistant"])
+    assistant_questions_count = message_count(session, "assistant")
 
+    fields = None
     if assistant_questions_count == 14:
-        next_question = "Would you like to share anything else about the product which would help us find you even better matches?"
+        next_question = LAST_QUESTION
     elif assistant_questions_count >= 15:
         return RedirectResponse(url="/complete", status_code=303)
     else:
-        # Ensure all timestamps in qa_log are strings
-        for item in qa_log:
-            if isinstance(item.get("timestamp"), datetime):
-                item["timestamp"] = item["timestamp"].isoformat()
-        next_question = run_agent(AskInput(
-            prompt="Based on the previous Q&A, ask the next most relevant question strictly related to understanding"
-                   " the user’s product, its logistics, buyer requirements, and supply-readiness."
-                   " You must cover all 3 of these before the 15th question if not already covered: Turnaround Time, Supply Capacity, Present Demand."
-                   " If the user gives a vague answer like 'I don’t know', 'not sure', or leaves it blank, try rephrasing the previous question in a more specific or guided way."
-                   " For example, if the question was about technical specifications and the user replied 'I don’t know', then follow up with:"
-                   " 'No worries! Would you know the dimensions, materials used, weight, power requirements, or any certifications it has?'"
-                   " Always give examples or typical attributes they can comment on."
-                   " Do NOT ask about market trends or insights. Do NOT ask for the user’s analysis of the market."
-                   " Avoid redundancy, and ask only what the user would realistically know and what helps find customers.",
-            history=history,
-            qa_items=qa_log
-        ))
-
-    store_message(session_uuid, next_question, "", role="assistant")
-
-    qa_log = get_qa_history(session_uuid)
+        ask_input, fields = next_question_input(session_uuid, session)
+        next_question = await run_agent_async(ask_input)
+
+    # ✅ Store next question (round-trip 2: counters only, the log is already in hand)
+    await store_message(session_uuid, next_question, "", role="assistant", history_limit=0, fields=fields)
+    qa_log.append({"question": next_question, "answer": "", "role": "assistant"})
 
     return templates.TemplateResponse(
         "index.html",
         {"request": request, "question": next_question, "qa_log": qa_log},
     )
 
+# Chat turns finishing in the background (see stream_answer)
+turn_tasks: Set[asyncio.Task] = set()
+
+def sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@router.post("/stream")
+async def stream_answer(request: Request, answer: Optional[str] = Form(None)):
+    """
+    Server-Sent Events version of POST / for a normal answer. Emits `token`
+    events while the next question is generated, then `question` with the
+    final (validated, stored) text, or `redirect` once the session is done.
+    """
+    session_uuid = request.session.get("chat_uuid")
+    user_answer = answer.strip() if answer else ""
+    if not session_uuid or user_answer == "":
+        return RedirectResponse(url="/", status_code=303)
+
+    session_uuid, session = await store_answer(request, session_uuid, user_answer)
+    assistant_questions_count = message_count(session, "assistant")
+
+    # The answer is already stored, so the next question must be stored too
+    # even if the client goes away mid-stream: generation runs in its own
+    # task, which a disconnect (cancelling `events`) does not cancel
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def produce():
+        try:
+            fields = None
+            if assistant_questions_count == 14:
+                next_question = LAST_QUESTION
+            else:
+                next_question = FALLBACK_QUESTION
+                ask_input, fields = next_question_input(session_uuid, session)
+                async for kind, text in stream_agent(ask_input):
+                    if kind == "token":
+                        queue.put_nowait(sse("token", {"text": text}))
+                    else:
+                        next_question = text
+
+            await store_message(session_uuid, next_question, "", role="assistant", history_limit=0, fields=fields)
+            queue.put_nowait(sse("question", {"text": next_question}))
+        finally:
+            queue.put_nowait(None)
+
+    if assistant_questions_count >= 15:
+        queue.put_nowait(sse("redirect", {"url": "/complete"}))
+        queue.put_nowait(None)
+    else:
+        task = asyncio.create_task(produce())
+        # The event loop only keeps weak references to tasks
+        turn_tasks.add(task)
+        task.add_done_callback(turn_tasks.discard)
+
+    async def events():
+        while (event := await queue.get()) is not None:
+            yield event
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @router.get("/complete", response_class=HTMLResponse)
 async def complete(request: Request):
     session_uuid = request.session.get("chat_uuid")
     if not session_uuid:
         return HTMLResponse("No conversation found.", status_code=404)
 
-    session = get_chat_session(session_uuid)
+    session = await get_chat_session(session_uuid)
     if not session:
         return HTMLResponse("No conversation found.", status_code=404)
 
-    qa_log = get_qa_history(session_uuid)
+    qa_log = session.get("messages", [])
 
-    # ✅ Start Module 2 in the background after chatbot session completes
-    def run_module2_background():
-        try:
-            print("🔍 Module 2 search pipeline started...")
-            run_search_pipeline()
-            print("✅ Module 2 search pipeline finished.")
-        except Exception as e:
-            print(f"❌ Error in Module 2 pipeline: {e}")
-
-    threading.Thread(target=run_module2_background).start()
+    # ✅ Queue Module 2 for this session (a refresh returns the same job
+    # unless it failed or the conversation changed since it finished);
+    # the worker (python -m module2.worker) picks it up
+    job = await enqueue_pipeline_job(session_uuid, session.get("updated_at"))
 
     # ✅ Optionally show search started message
     return templates.TemplateResponse(
-        "complete.html", {"request": request, "qa_log": qa_log, "search_started": True}
+        "complete.html", {"request": request, "qa_log": qa_log, "search_started": True, "job": job}
+    )
+
+@router.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = await get_pipeline_job(job_id)
+    if not job:
+        return JSONResponse({"detail": "Job not found"}, status_code=404)
+    return JSONResponse(jsonable_encoder({
+        "id": job["_id"],
+        "session_uuid": job["session_uuid"],
+        "state": job["state"],
+        "attempts": job.get("attempts", 0),
+        "progress": job.get("progress", {}),
+        "error": job.get("error"),
+        "created_at": job.get("created_at"),
+        "updated_at": job.get("updated_at"),
+        "finished_at": job.get("finished_at"),
+    }))
+
+@router.post("/jobs/{job_id}/rerun")
+async def rerun_job(job_id: str):
+    """Queues a finished job again (no-op while it is queued or running)."""
+    job = await get_pipeline_job(job_id)
+    if not job:
+        return JSONResponse({"detail": "Job not found"}, status_code=404)
+    await enqueue_pipeline_job(job["session_uuid"], force=True)
+    return RedirectResponse(url="/complete", status_code=303)
+
+@router.get("/health/db")
+async def db_health():
+    """Mongo connection pool counters for this process."""
+    return pool_stats()
+
+@router.get("/health/limits")
+async def rate_limit_health():
+    """Per-upstream rate limiter state (in flight, AIMD limit, throttles) for this process."""
+    return limiter_stats()
+
+@router.get("/health/hedging")
+async def hedging_health():
+    """How often hedged turns fired a second completion, who won, and the latency saved, for this process."""
+    return hedge_stats.as_dict()
+
+@router.get("/health/guardrails")
+async def guardrails_health():
+    """Questions checked and rejected, and how often each guardrail rule fired, for this process."""
+    return guardrail_stats()
+
+JOB_EVENTS_POLL_SECONDS = 1.0
+
+@router.get("/jobs/{job_id}/events")
+async def job_events(request: Request, job_id: str):
+    """
+    SSE feed for the completion page: `progress` whenever the job document
+    changes, `application` for every stored application result (with its
+    companies), and `done` once the job has finished or failed.
+    """
+    job = await get_pipeline_job(job_id)
+    if not job:
+        return JSONResponse({"detail": "Job not found"}, status_code=404)
+
+    async def events():
+        since = None
+        last_update = None
+        while not await request.is_disconnected():
+            job = await get_pipeline_job(job_id)
+            if not job:
+                # Deleted while the page was open (e.g. swept by an operator)
+                yield sse("done", {"state": "failed", "error": "Job not found"})
+                return
+            if job["updated_at"] != last_update:
+                last_update = job["updated_at"]
+                yield sse("progress", jsonable_encoder({"state": job["state"], "progress": job.get("progress", {})}))
+
+            for doc in await get_results_since(job["session_uuid"], since):
+                since = doc["updated_at"]
+                yield sse("application", jsonable_encoder(doc))
+
+            if job["state"] in ("done", "failed"):
+                yield sse("done", {"state": job["state"], "error": job.get("error")})
+                return
+            await asyncio.sleep(JOB_EVENTS_POLL_SECONDS)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
@@ -0,0 +1,97 @@
+import os
+import re
+import zlib
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+
+# Cosine similarity at or above which two questions count as duplicates.
+DUPLICATE_THRESHOLD = float(os.getenv("DUPLICATE_THRESHOLD", "0.7"))
+
+# Hashed feature space for word tokens + character trigrams.
+DIMENSIONS = 2 ** 12
+
+_non_word = re.compile(r"[^a-z0-9\s]+")
+_spaces = re.compile(r"\s+")
+
+def normalize(text: str) -> str:
+    return _spaces.sub(" ", _non_word.sub(" ", text.lower())).strip()
+
+def features(text: str) -> List[str]:
+    """Word tokens plus character trigrams, so rewordings still overlap."""
+    norm = normalize(text)
+    padded = f" {norm} "
+    return norm.split() + [padded[i:i + 3] for i in range(len(padded) - 2)]
+
+def vectorize(text: str) -> np.ndarray:
+    vector = np.zeros(DIMENSIONS, dtype=np.float32)
+    for feature in features(text):
+        vector[zlib.crc32(feature.encode("utf-8")) % DIMENSIONS] += 1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+class QuestionIndex:
+    """
+    Unit vectors for a set of questions, stored as rows of one matrix so a
+    lookup is a single matrix-vector product.
+    """
+
+    def __init__(self, questions: Optional[List[str]] = None):
+        self.matrix = np.zeros((16, DIMENSIONS), dtype=np.float32)
+        self.size = 0
+        for question in questions or []:
+            self.add(question)
+
+    def add(self, question: str) -> None:
+        if self.size == len(self.matrix):
+            self.matrix = np.vstack([self.matrix, np.zeros_like(self.matrix)])
+        self.matrix[self.size] = vectorize(question)
+        self.size += 1
+
+    def similarities(self, question: str) -> np.ndarray:
+        return self.matrix[:self.size] @ vectorize(question)
+
+    def max_similarity(self, question: str) -> float:
+        if not self.size:
+            return 0.0
+        return float(self.similarities(question).max())
+
+    def contains(self, question: str, threshold: float = DUPLICATE_THRESHOLD) -> bool:
+        return self.max_similarity(question) >= threshold
+
+def assistant_questions(qa_items) -> List[str]:
+    return [item["question"] for item in qa_items if item["role"] == "assistant"]
+
+class SessionIndexes:
+    """
+    One QuestionIndex per chat session, kept across turns (LRU-bounded).
+    Each lookup only vectorizes assistant questions the index has not seen
+    yet, so the index grows with the session instead of being rebuilt, and
+    a restarted worker catches up from the stored log on first use.
+    """
+
+    def __init__(self, max_sessions: int = 2000):
+        self.max_sessions = max_sessions
+        self.indexes: "OrderedDict[str, QuestionIndex]" = OrderedDict()
+
+    def get(self, session_uuid: str, qa_items) -> QuestionIndex:
+        index = self.indexes.pop(session_uuid, None) or QuestionIndex()
+        self.indexes[session_uuid] = index
+        while len(self.indexes) > self.max_sessions:
+            self.indexes.popitem(last=False)
+
+        questions = assistant_questions(qa_items)
+        for question in questions[index.size:]:
+            index.add(question)
+        return index
+
+session_indexes = SessionIndexes()
+
+def is_duplicate(question: str, qa_items, threshold: Optional[float] = None, session_uuid: Optional[str] = None) -> bool:
+    threshold = DUPLICATE_THRESHOLD if threshold is None else threshold
+    if session_uuid:
+        index = session_indexes.get(session_uuid, qa_items)
+    else:
+        index = QuestionIndex(assistant_questions(qa_items))
+    return index.contains(question, threshold)
@@ -0,0 +1,10 @@
+# common/__init__.py
+
+"""
+Shared infrastructure used by both the chatbot app and Module 2:
+
+1. Tiered (in-memory LRU + SQLite) caches for LLM responses and API results.
+2. Process-wide pooled Mongo clients (sync for Module 2, motor for the app).
+3. Index provisioning and explain()-based query-plan checks.
+4. Per-upstream adaptive rate limiting (OpenAI, Places) with chat priority.
+"""
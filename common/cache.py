@@ -0,0 +1,106 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+CACHE_DIR = os.getenv("CACHE_DIR", ".cache")
+
+_MISSING = object()
+
+class TieredCache:
+    """
+    Key/value cache with an in-memory LRU tier in front of a persistent
+    SQLite tier. Values must be JSON-serialisable. Entries expire after
+    `ttl` seconds (None = never) and each tier is capped at `max_entries`,
+    evicting the least recently used (memory) / oldest written (disk).
+    Thread-safe; one SQLite file per namespace.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        ttl: Optional[float] = None,
+        max_entries: int = 10000,
+        memory_entries: int = 1000,
+        directory: str = CACHE_DIR,
+    ):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.lock = threading.Lock()
+        self.memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "writes": 0}
+
+        os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(directory, f"{namespace}.sqlite3"), check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL, written_at REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS cache_written_at ON cache (written_at)")
+        self.db.commit()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > now:
+                    self.memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return value
+                del self.memory[key]
+
+            row = self.db.execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] <= now):
+                self.stats["misses"] += 1
+                return default
+
+            value = json.loads(row[0])
+            self._remember(key, value, row[1])
+            self.stats["disk_hits"] += 1
+            return value
+
+    def set(self, key: str, value: Any, ttl: Any = _MISSING) -> None:
+        ttl = self.ttl if ttl is _MISSING else ttl
+        now = time.time()
+        expires_at = now + ttl if ttl is not None else None
+        with self.lock:
+            self._remember(key, value, expires_at)
+            self.db.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at, written_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), expires_at, now),
+            )
+            self.stats["writes"] += 1
+            self._evict(now)
+            self.db.commit()
+
+    def _remember(self, key: str, value: Any, expires_at: Optional[float]) -> None:
+        self.memory[key] = (value, expires_at)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def _evict(self, now: float) -> None:
+        self.db.execute("DELETE FROM cache WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+        (count,) = self.db.execute("SELECT COUNT(*) FROM cache").fetchone()
+        if count > self.max_entries:
+            self.db.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY written_at LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def info(self) -> Dict[str, Any]:
+        with self.lock:
+            (count,) = self.db.execute("SELECT COUNT(*) FROM cache").fetchone()
+            return {"namespace": self.namespace, "memory_entries": len(self.memory), "disk_entries": count, **self.stats}
+
+def content_key(*parts: Any) -> str:
+    """Stable SHA-256 over JSON-encoded parts (dict keys sorted)."""
+    payload = json.dumps(parts, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
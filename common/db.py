@@ -0,0 +1,124 @@
+import os
+import threading
+from typing import Dict, Optional
+
+import certifi
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import MongoClient
+from pymongo.monitoring import ConnectionPoolListener
+
+load_dotenv()
+
+# The web app historically read MONGO_URL and Module 2 MONGODB_URL
+MONGO_URL = os.getenv("MONGO_URL") or os.getenv("MONGODB_URL")
+
+# Pool sizing and timeouts, shared by both clients
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "300000"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "10000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "10000"))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "10000"))
+
+# Databases / collections
+CHAT_DB_NAME = "chatbot_db"
+SESSIONS_COLLECTION_NAME = "chat_sessions"
+JOBS_COLLECTION_NAME = "pipeline_jobs"
+RATE_LIMITS_COLLECTION_NAME = "rate_limits"
+RESULTS_DB_NAME = os.getenv("MONGO_DB_NAME", CHAT_DB_NAME)
+RESULTS_COLLECTION_NAME = os.getenv("MONGO_COLLECTION_NAME", "search_results")
+COMPANIES_COLLECTION_NAME = os.getenv("MONGO_COMPANIES_COLLECTION_NAME", "companies")
+
+class PoolStats(ConnectionPoolListener):
+    """Connection pool counters from pymongo's CMAP events."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {
+            "pools_created": 0,
+            "connections_created": 0,
+            "connections_closed": 0,
+            "checked_out": 0,
+            "checked_in": 0,
+            "checkout_failed": 0,
+        }
+
+    def _bump(self, name: str) -> None:
+        with self.lock:
+            self.counters[name] += 1
+
+    def pool_created(self, event): self._bump("pools_created")
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_created(self, event): self._bump("connections_created")
+    def connection_ready(self, event): pass
+    def connection_closed(self, event): self._bump("connections_closed")
+    def connection_check_out_started(self, event): pass
+    def connection_check_out_failed(self, event): self._bump("checkout_failed")
+    def connection_checked_out(self, event): self._bump("checked_out")
+    def connection_checked_in(self, event): self._bump("checked_in")
+
+    def snapshot(self) -> Dict[str, int]:
+        with self.lock:
+            counters = dict(self.counters)
+        counters["open"] = counters["connections_created"] - counters["connections_closed"]
+        counters["in_use"] = counters["checked_out"] - counters["checked_in"]
+        return counters
+
+_lock = threading.Lock()
+_sync_client: Optional[MongoClient] = None
+_async_client: Optional[AsyncIOMotorClient] = None
+_sync_stats = PoolStats()
+_async_stats = PoolStats()
+
+def client_options(listener: PoolStats) -> Dict:
+    if not MONGO_URL:
+        raise RuntimeError("MONGO_URL (or MONGODB_URL) not found in environment variables")
+    options = {
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "maxIdleTimeMS": MONGO_MAX_IDLE_TIME_MS,
+        "connectTimeoutMS": MONGO_CONNECT_TIMEOUT_MS,
+        "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        "waitQueueTimeoutMS": MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        "event_listeners": [listener],
+    }
+    # Atlas (SRV) needs a CA bundle; a plain local mongod must not get TLS forced on
+    if MONGO_URL.startswith("mongodb+srv://") or "tls=true" in MONGO_URL or "ssl=true" in MONGO_URL:
+        options["tlsCAFile"] = certifi.where()
+    return options
+
+def get_sync_client() -> MongoClient:
+    """Process-wide pymongo client (pipeline worker, scripts)."""
+    global _sync_client
+    with _lock:
+        if _sync_client is None:
+            _sync_client = MongoClient(MONGO_URL, **client_options(_sync_stats))
+        return _sync_client
+
+def get_async_client() -> AsyncIOMotorClient:
+    """Process-wide motor client (web app); created at FastAPI startup."""
+    global _async_client
+    with _lock:
+        if _async_client is None:
+            _async_client = AsyncIOMotorClient(MONGO_URL, **client_options(_async_stats))
+        return _async_client
+
+def close_clients() -> None:
+    global _sync_client, _async_client
+    with _lock:
+        if _sync_client is not None:
+            _sync_client.close()
+            _sync_client = None
+        if _async_client is not None:
+            _async_client.close()
+            _async_client = None
+
+def pool_stats() -> Dict[str, Dict]:
+    return {
+        "max_pool_size": MONGO_MAX_POOL_SIZE,
+        "sync": {"connected": _sync_client is not None, **_sync_stats.snapshot()},
+        "async": {"connected": _async_client is not None, **_async_stats.snapshot()},
+    }
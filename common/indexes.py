@@ -0,0 +1,211 @@
+# common/indexes.py
+
+"""
+Index provisioning and query-plan checks for every collection we query.
+
+    python -m common.indexes            # create/update the indexes
+    python -m common.indexes --explain  # explain() each query shape, flag COLLSCANs
+
+`ensure_indexes()` is idempotent and runs when the pipeline worker starts;
+app startup (main.py) runs `ensure_indexes_async()`, the same provisioning
+through the motor client. SESSION_TTL_DAYS > 0 expires chat sessions that
+have not been written to for that many days (TTL on `updated_at`); 0 keeps
+them forever.
+"""
+
+import os
+import sys
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from pymongo import ASCENDING, DESCENDING, MongoClient
+from pymongo.errors import OperationFailure
+
+from .db import (
+    get_sync_client, get_async_client, CHAT_DB_NAME, SESSIONS_COLLECTION_NAME, JOBS_COLLECTION_NAME,
+    RESULTS_DB_NAME, RESULTS_COLLECTION_NAME, COMPANIES_COLLECTION_NAME,
+)
+
+SESSION_TTL_DAYS = float(os.getenv("SESSION_TTL_DAYS", "0"))
+SESSION_TTL_INDEX = "session_ttl"
+
+# (database, collection) -> [(keys, options)]
+INDEXES: Dict[Tuple[str, str], List[Tuple[List, Dict]]] = {
+    (CHAT_DB_NAME, SESSIONS_COLLECTION_NAME): [
+        ([("session_uuid", ASCENDING)], {"unique": True}),
+    ],
+    (CHAT_DB_NAME, JOBS_COLLECTION_NAME): [
+        ([("session_uuid", ASCENDING)], {"unique": True}),
+        # claim_job: state (+ lease expiry for stale leases), oldest first
+        ([("state", ASCENDING), ("lease_expires_at", ASCENDING), ("created_at", ASCENDING)], {}),
+    ],
+    (RESULTS_DB_NAME, RESULTS_COLLECTION_NAME): [
+        # Per-application upserts; also serves lookups by session alone
+        ([("session_uuid", ASCENDING), ("application", ASCENDING)], {"unique": True}),
+        # get_results_since polls by session ordered by updated_at
+        ([("session_uuid", ASCENDING), ("updated_at", ASCENDING)], {}),
+    ],
+    (RESULTS_DB_NAME, COMPANIES_COLLECTION_NAME): [
+        # Companies are keyed by Places id through `_id`, which is already unique
+        ([("applications", ASCENDING)], {}),
+    ],
+}
+
+_provisioned = False
+_provision_lock = threading.Lock()
+
+# One provisioning step: (database, collection or None for a database
+# command, method, args, kwargs), applied the same way on either client
+IndexOperation = Tuple[str, Optional[str], str, tuple, Dict]
+
+def session_ttl_operations(existing: Optional[Dict], days: float) -> List[IndexOperation]:
+    """Operations that create, retune (collMod) or drop the session TTL index to match `days`."""
+    target = (CHAT_DB_NAME, SESSIONS_COLLECTION_NAME)
+    if days <= 0:
+        return [(*target, "drop_index", (SESSION_TTL_INDEX,), {})] if existing else []
+    seconds = int(days * 86400)
+    if not existing:
+        return [(*target, "create_index", ([("updated_at", ASCENDING)],), {"name": SESSION_TTL_INDEX, "expireAfterSeconds": seconds})]
+    if existing.get("expireAfterSeconds") != seconds:
+        return [(CHAT_DB_NAME, None, "command", ("collMod", SESSIONS_COLLECTION_NAME), {
+            "index": {"name": SESSION_TTL_INDEX, "expireAfterSeconds": seconds},
+        })]
+    return []
+
+def index_operations(session_ttl_index: Optional[Dict]) -> List[IndexOperation]:
+    """Every index in INDEXES plus the session TTL, given the TTL index as it exists now (or None)."""
+    operations = [
+        (db_name, collection_name, "create_index", (keys,), options)
+        for (db_name, collection_name), indexes in INDEXES.items()
+        for keys, options in indexes
+    ]
+    return operations + session_ttl_operations(session_ttl_index, SESSION_TTL_DAYS)
+
+def operation_target(client: Any, operation: IndexOperation) -> Callable:
+    db_name, collection_name, method, _, _ = operation
+    database = client[db_name]
+    return getattr(database if collection_name is None else database[collection_name], method)
+
+def log_failure(operation: IndexOperation, error: OperationFailure) -> None:
+    db_name, collection_name, method, args, _ = operation
+    logging.error(f"Index operation {method}{args} on {db_name}.{collection_name or '*'} failed: {error}")
+
+def ensure_indexes(client: Optional[MongoClient] = None, force: bool = False) -> None:
+    """
+    Applies index_operations() (creating an index that already exists is a
+    no-op). Runs once per process unless `force` is given. A failing
+    operation (e.g. a unique index over legacy duplicates) is logged rather
+    than raised so the app still starts.
+    """
+    global _provisioned
+    with _provision_lock:
+        if _provisioned and not force:
+            return
+        client = client or get_sync_client()
+        try:
+            ttl_index = client[CHAT_DB_NAME][SESSIONS_COLLECTION_NAME].index_information().get(SESSION_TTL_INDEX)
+        except OperationFailure as e:
+            logging.error(f"Could not read the session indexes: {e}")
+            ttl_index = None
+        for operation in index_operations(ttl_index):
+            try:
+                operation_target(client, operation)(*operation[3], **operation[4])
+            except OperationFailure as e:
+                log_failure(operation, e)
+        _provisioned = True
+
+async def ensure_indexes_async(client: Any = None, force: bool = False) -> None:
+    """
+    ensure_indexes through the shared motor client, for the web process,
+    which would otherwise open a pymongo pool just to provision indexes.
+    """
+    global _provisioned
+    if _provisioned and not force:
+        return
+    client = client or get_async_client()
+    try:
+        ttl_index = (await client[CHAT_DB_NAME][SESSIONS_COLLECTION_NAME].index_information()).get(SESSION_TTL_INDEX)
+    except OperationFailure as e:
+        logging.error(f"Could not read the session indexes: {e}")
+        ttl_index = None
+    for operation in index_operations(ttl_index):
+        try:
+            await operation_target(client, operation)(*operation[3], **operation[4])
+        except OperationFailure as e:
+            log_failure(operation, e)
+    _provisioned = True
+
+# ------------------ Query plan checks ------------------
+# One entry per query shape the code issues: (name, database, collection, filter, sort)
+QUERY_SHAPES = [
+    ("sessions by uuid (app.mongo, engine)", CHAT_DB_NAME, SESSIONS_COLLECTION_NAME,
+     {"session_uuid": "x"}, None),
+    ("latest session (engine)", CHAT_DB_NAME, SESSIONS_COLLECTION_NAME,
+     {}, [("_id", DESCENDING)]),
+    ("job by session (enqueue)", CHAT_DB_NAME, JOBS_COLLECTION_NAME,
+     {"session_uuid": "x"}, None),
+    ("job by id", CHAT_DB_NAME, JOBS_COLLECTION_NAME,
+     {"_id": "x"}, None),
+    ("claim job (worker)", CHAT_DB_NAME, JOBS_COLLECTION_NAME,
+     {"$or": [{"state": "queued"}, {"state": "running", "lease_expires_at": {"$lt": datetime.now()}}],
+      "attempts": {"$lt": 3}},
+     [("created_at", ASCENDING)]),
+    ("renew lease (worker)", CHAT_DB_NAME, JOBS_COLLECTION_NAME,
+     {"_id": "x", "worker_id": "w", "state": "running"}, None),
+    ("result upsert (engine)", RESULTS_DB_NAME, RESULTS_COLLECTION_NAME,
+     {"session_uuid": "x", "application": "a"}, None),
+    ("results since (job events)", RESULTS_DB_NAME, RESULTS_COLLECTION_NAME,
+     {"session_uuid": "x", "updated_at": {"$gt": datetime.now()}}, [("updated_at", ASCENDING)]),
+    ("companies by ids (job events)", RESULTS_DB_NAME, COMPANIES_COLLECTION_NAME,
+     {"_id": {"$in": ["x", "y"]}}, None),
+    ("companies by application", RESULTS_DB_NAME, COMPANIES_COLLECTION_NAME,
+     {"applications": "a"}, None),
+]
+
+def plan_stages(plan: Dict) -> List[str]:
+    """Every `stage` name in an explain() plan tree (classic or SBE layout)."""
+    stages = []
+    if "stage" in plan:
+        stages.append(plan["stage"])
+    for key in ("inputStage", "queryPlan"):
+        if isinstance(plan.get(key), dict):
+            stages.extend(plan_stages(plan[key]))
+    for child in plan.get("inputStages", []):
+        stages.extend(plan_stages(child))
+    return stages
+
+def explain_queries(client: Optional[MongoClient] = None) -> List[Dict]:
+    client = client or get_sync_client()
+    report = []
+    for name, db_name, collection_name, query, sort in QUERY_SHAPES:
+        cursor = client[db_name][collection_name].find(query).limit(1)
+        if sort:
+            cursor = cursor.sort(sort)
+        winning_plan = cursor.explain()["queryPlanner"]["winningPlan"]
+        stages = plan_stages(winning_plan)
+        report.append({
+            "name": name,
+            "collection": f"{db_name}.{collection_name}",
+            "stages": stages,
+            "collscan": "COLLSCAN" in stages,
+        })
+    return report
+
+def main(argv: List[str]) -> int:
+    ensure_indexes(force=True)
+    print("Indexes provisioned")
+    if "--explain" not in argv:
+        return 0
+
+    report = explain_queries()
+    for row in report:
+        flag = "COLLSCAN" if row["collscan"] else "ok"
+        print(f"[{flag:>8}] {row['name']:<36} {row['collection']:<32} {' > '.join(row['stages'])}")
+    scans = sum(row["collscan"] for row in report)
+    print(f"{scans} of {len(report)} query shapes do a collection scan")
+    return 1 if scans else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,32 @@
+import os
+from typing import Any, Optional
+
+from .cache import TieredCache, content_key
+
+# LLM_CACHE=false turns the cache off; LLM_CACHE_MAX_TEMPERATURE (if set)
+# bypasses it for calls sampled above that temperature.
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE", "true").lower() == "true"
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "20000"))
+_max_temperature = os.getenv("LLM_CACHE_MAX_TEMPERATURE")
+LLM_CACHE_MAX_TEMPERATURE = float(_max_temperature) if _max_temperature else None
+
+llm_cache = TieredCache("llm", ttl=LLM_CACHE_TTL, max_entries=LLM_CACHE_MAX_ENTRIES)
+
+def llm_key(
+    model: str,
+    messages: Any,
+    temperature: Optional[float] = None,
+    output_type: Optional[str] = None,
+    **params: Any,
+) -> Optional[str]:
+    """
+    Cache key for one LLM call, or None when the call should not be cached
+    (cache disabled, or temperature above LLM_CACHE_MAX_TEMPERATURE).
+    `messages` is the chat message list or the raw prompt string.
+    """
+    if not LLM_CACHE_ENABLED:
+        return None
+    if LLM_CACHE_MAX_TEMPERATURE is not None and (temperature or 0.0) > LLM_CACHE_MAX_TEMPERATURE:
+        return None
+    return content_key(model, messages, temperature, output_type, params)
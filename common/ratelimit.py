@@ -0,0 +1,433 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import itertools
+import threading
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+
+from .db import get_async_client, get_sync_client, CHAT_DB_NAME, RATE_LIMITS_COLLECTION_NAME
+
+# Chat turns are served before background (pipeline) work waiting on the same upstream
+INTERACTIVE, BACKGROUND = 0, 1
+
+# Retries of throttled (429/5xx) background calls, with full-jitter
+# exponential backoff between RATE_LIMIT_BACKOFF_BASE and _CAP seconds
+RATE_LIMIT_RETRIES = int(os.getenv("RATE_LIMIT_RETRIES", "4"))
+RATE_LIMIT_BACKOFF_BASE = float(os.getenv("RATE_LIMIT_BACKOFF_BASE", "0.5"))
+RATE_LIMIT_BACKOFF_CAP = float(os.getenv("RATE_LIMIT_BACKOFF_CAP", "30"))
+
+# Per upstream defaults: requests/second, burst, max concurrent requests.
+# Override with RATE_LIMIT_<NAME>_RPS / _BURST / _CONCURRENCY.
+UPSTREAM_DEFAULTS = {
+    "openai": (8.0, 16, 16),
+    "places": (10.0, 20, 10),
+}
+# In-flight slots background work leaves free for chat turns
+RATE_LIMIT_INTERACTIVE_RESERVE = int(os.getenv("RATE_LIMIT_INTERACTIVE_RESERVE", "1"))
+
+# Cross-process budget (SharedBucket): the web app and every worker draw
+# from one token bucket per upstream stored in Mongo. Background callers
+# leave RATE_LIMIT_RESERVE_TOKENS in it and stand back for
+# RATE_LIMIT_INTERACTIVE_HOLD seconds after a chat turn found it empty.
+RATE_LIMIT_SHARED = os.getenv("RATE_LIMIT_SHARED", "true").lower() == "true"
+RATE_LIMIT_RESERVE_TOKENS = float(os.getenv("RATE_LIMIT_RESERVE_TOKENS", "2"))
+RATE_LIMIT_INTERACTIVE_HOLD = float(os.getenv("RATE_LIMIT_INTERACTIVE_HOLD", "1"))
+
+class UpstreamError(Exception):
+    """Raised by callers for an upstream HTTP error the limiter should see (status, Retry-After)."""
+
+    def __init__(self, status_code: int, retry_after: Optional[float] = None, message: str = ""):
+        super().__init__(message or f"upstream returned HTTP {status_code}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+def parse_retry_after(headers: Any) -> Optional[float]:
+    """Seconds from `retry-after-ms` / `Retry-After` (seconds or HTTP date), if present."""
+    if not headers:
+        return None
+    try:
+        value = headers.get("retry-after-ms")
+        if value:
+            return max(0.0, float(value) / 1000)
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def throttle_info(error: BaseException) -> Optional[Tuple[int, Optional[float]]]:
+    """
+    (status, retry_after) when `error` means the upstream is overloaded or
+    rate limiting us (429 or 5xx), else None. Duck-typed so it works for
+    UpstreamError, openai.APIStatusError, httpx.HTTPStatusError and
+    pydantic_ai's ModelHTTPError alike.
+    """
+    response = getattr(error, "response", None)
+    status = getattr(error, "status_code", None) or getattr(response, "status_code", None)
+    if not isinstance(status, int) or not (status == 429 or status >= 500):
+        return None
+    retry_after = getattr(error, "retry_after", None)
+    if retry_after is None:
+        retry_after = parse_retry_after(getattr(response, "headers", None))
+    return status, retry_after
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """Full-jitter exponential backoff, never shorter than the server's Retry-After."""
+    delay = random.uniform(0, min(RATE_LIMIT_BACKOFF_CAP, RATE_LIMIT_BACKOFF_BASE * 2 ** attempt))
+    return max(delay, retry_after or 0.0)
+
+class RateLimiter:
+    """
+    Admission control for one upstream, shared by every event loop and
+    thread in the process (state sits behind a threading.Lock; waiters are
+    woken on their own loop with call_soon_threadsafe).
+
+    - Token bucket: `rate` requests/second with bursts up to `burst`.
+    - AIMD concurrency: the in-flight limit grows by 1/limit per success up
+      to `max_concurrency` and halves on a 429/5xx; a Retry-After pauses
+      the whole upstream until it has passed.
+    - Priority: while an INTERACTIVE caller waits, BACKGROUND callers are
+      not admitted, and background work never takes the last `reserve`
+      slots, so chat turns only queue behind other chat turns.
+    - With a SharedBucket attached (see share_limits), every admission also
+      takes a token from the upstream's cross-process bucket, so the rate
+      and any Retry-After pause hold across the web app and the workers.
+      INTERACTIVE calls never wait on it (no Mongo round-trip before a chat
+      completion): their token is debited afterwards in the background, and
+      BACKGROUND callers absorb the debt. Concurrency stays per process.
+
+    Use `async with limiter.slot(priority):` around one request, or
+    `await limiter.call(fn)` to also retry throttled requests with backoff.
+    """
+
+    def __init__(self, name: str, rate: float, burst: int, max_concurrency: int, reserve: int = RATE_LIMIT_INTERACTIVE_RESERVE):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = 1
+        self.reserve = min(reserve, max_concurrency - 1)
+        self.limit = float(max_concurrency)
+        self.tokens = float(burst)
+        self.refilled_at = time.monotonic()
+        self.paused_until = 0.0
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.waiters: List[tuple] = []  # (priority, seq, loop, future)
+        self.sequence = itertools.count()
+        self.stats = {"admitted": 0, "throttled": 0, "retries": 0, "waited_seconds": 0.0}
+        self.shared: Optional["SharedBucket"] = None
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+
+    def _try_acquire(self, priority: int, seq: Optional[int]) -> Optional[float]:
+        """0 when admitted; else seconds until worth retrying (None = until a release)."""
+        now = time.monotonic()
+        self._refill(now)
+        if now < self.paused_until:
+            return self.paused_until - now
+        # Higher-priority waiters (and earlier ones of the same priority) go first
+        for waiter_priority, waiter_seq, _, _ in self.waiters:
+            if waiter_seq != seq and (waiter_priority, waiter_seq) < (priority, seq if seq is not None else float("inf")):
+                return None
+        # Background keeps `reserve` slots free, but is never shut out entirely
+        capacity = max(1, int(self.limit) - (self.reserve if priority != INTERACTIVE else 0))
+        if self.in_flight >= capacity:
+            return None
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+        self.tokens -= 1
+        self.in_flight += 1
+        self.stats["admitted"] += 1
+        return 0
+
+    def _wake_all(self) -> None:
+        for _, _, loop, future in self.waiters:
+            try:
+                loop.call_soon_threadsafe(_resolve, future)
+            except RuntimeError:
+                pass  # that waiter's loop has closed
+
+    async def acquire(self, priority: int = BACKGROUND) -> None:
+        await self._admit(priority)
+        if self.shared is None:
+            return
+        if priority == INTERACTIVE:
+            self.shared.debit_later()
+            return
+        try:
+            await self.shared.acquire()
+        except BaseException:
+            # Admitted locally but gave up on the shared bucket (timeout, cancel)
+            self.release(succeeded=False)
+            raise
+
+    async def _admit(self, priority: int) -> None:
+        """Local admission: priority order, AIMD concurrency and the per-process bucket."""
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        seq = None
+        entry = None
+        try:
+            while True:
+                with self.lock:
+                    wait = self._try_acquire(priority, seq)
+                    if wait == 0:
+                        if entry is not None:
+                            self.waiters.remove(entry)
+                            entry = None
+                            # The next waiter in line may be admissible too
+                            self._wake_all()
+                        self.stats["waited_seconds"] += time.monotonic() - started
+                        return
+                    future = loop.create_future()
+                    if entry is None:
+                        seq = next(self.sequence)
+                    else:
+                        self.waiters.remove(entry)
+                    entry = (priority, seq, loop, future)
+                    self.waiters.append(entry)
+                try:
+                    # Bounded wait so a missed wake-up only costs a poll
+                    await asyncio.wait_for(future, min(wait, 1.0) if wait is not None else 1.0)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if entry is not None:
+                with self.lock:
+                    if entry in self.waiters:
+                        self.waiters.remove(entry)
+                    self._wake_all()
+
+    def release(self, throttled: bool = False, retry_after: Optional[float] = None, succeeded: bool = True) -> None:
+        with self.lock:
+            self.in_flight -= 1
+            if throttled:
+                self.stats["throttled"] += 1
+                self.limit = max(self.min_concurrency, self.limit / 2)
+                self.tokens = 0.0
+                if retry_after:
+                    self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+                logging.warning(f"Rate limiter '{self.name}': throttled, concurrency limit now {self.limit:.1f}")
+            elif succeeded:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self._wake_all()
+
+    @asynccontextmanager
+    async def slot(self, priority: int = BACKGROUND, timeout: Optional[float] = None) -> AsyncIterator[None]:
+        """One admitted request. `timeout` bounds the wait for admission (asyncio.TimeoutError)."""
+        if timeout is None:
+            await self.acquire(priority)
+        else:
+            await asyncio.wait_for(self.acquire(priority), timeout)
+        try:
+            yield
+        except BaseException as e:
+            info = throttle_info(e)
+            # Timeouts and cancellations say nothing about the upstream's capacity
+            self.release(throttled=info is not None, retry_after=info[1] if info else None, succeeded=False)
+            if info is not None and self.shared is not None:
+                await self.shared.throttle(info[1])
+            raise
+        else:
+            self.release()
+
+    async def call(
+        self,
+        fn: Callable[[], Awaitable[Any]],
+        priority: int = BACKGROUND,
+        retries: int = RATE_LIMIT_RETRIES,
+    ) -> Any:
+        """`await fn()` in a slot, retrying throttled attempts with jittered backoff."""
+        for attempt in range(retries + 1):
+            try:
+                async with self.slot(priority):
+                    return await fn()
+            except Exception as e:
+                info = throttle_info(e)
+                if info is None or attempt == retries:
+                    raise
+                delay = backoff_delay(attempt, info[1])
+                with self.lock:
+                    self.stats["retries"] += 1
+                logging.info(f"Rate limiter '{self.name}': HTTP {info[0]}, retry {attempt + 1}/{retries} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    def info(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "in_flight": self.in_flight,
+                "concurrency_limit": round(self.limit, 2),
+                "tokens": round(self.tokens, 2),
+                "waiting": len(self.waiters),
+                "paused_for": round(max(0.0, self.paused_until - time.monotonic()), 2),
+                "shared": self.shared is not None,
+                **self.stats,
+            }
+
+class SharedBucket:
+    """
+    Token bucket for one upstream kept in a Mongo document, so every
+    process shares one budget. One atomic pipeline update per attempt
+    refills by elapsed wall-clock time and takes a token if allowed.
+    `acquire` (BACKGROUND) needs 1 + `reserve_tokens` tokens, no pause and
+    no recent chat turn that found the bucket empty; `debit` takes the token
+    of an INTERACTIVE call after the fact, possibly into debt, and records
+    an empty bucket in `interactive_until`. A throttled request empties the
+    bucket and pauses it for Retry-After. Works with a motor (`is_async`)
+    or pymongo collection; if Mongo is unreachable, callers fall back to
+    the local limits rather than stall.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        burst: int,
+        collection: Callable[[], Any],
+        is_async: bool,
+        reserve_tokens: float = RATE_LIMIT_RESERVE_TOKENS,
+        interactive_hold: float = RATE_LIMIT_INTERACTIVE_HOLD,
+    ):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.collection = collection
+        self.is_async = is_async
+        self.reserve_tokens = min(reserve_tokens, burst - 1)
+        self.interactive_hold = interactive_hold
+        self.debits: Set[asyncio.Task] = set()
+
+    async def _update(self, update: Any) -> Optional[Dict]:
+        collection = self.collection()
+        options = {"upsert": True, "return_document": ReturnDocument.AFTER}
+        try:
+            if self.is_async:
+                return await collection.find_one_and_update({"_id": self.name}, update, **options)
+            return await asyncio.to_thread(collection.find_one_and_update, {"_id": self.name}, update, **options)
+        except PyMongoError as e:
+            logging.error(f"Shared rate limit '{self.name}' unavailable, using local limits only: {e}")
+            return None
+
+    def _refill(self, now: float) -> Dict:
+        """Pipeline stage topping the bucket up for the wall-clock time since its last update."""
+        elapsed = {"$max": [0, {"$subtract": [now, {"$ifNull": ["$refilled_at", now]}]}]}
+        return {"$set": {
+            "tokens": {"$min": [self.burst, {"$add": [{"$ifNull": ["$tokens", self.burst]}, {"$multiply": [elapsed, self.rate]}]}]},
+            "refilled_at": now,
+        }}
+
+    async def acquire(self) -> None:
+        needed = 1 + self.reserve_tokens
+        while True:
+            now = time.time()
+            doc = await self._update([
+                self._refill(now),
+                {"$set": {"granted": {"$and": [
+                    {"$gte": ["$tokens", needed]},
+                    {"$lte": [{"$ifNull": ["$paused_until", 0]}, now]},
+                    {"$lte": [{"$ifNull": ["$interactive_until", 0]}, now]},
+                ]}}},
+                {"$set": {"tokens": {"$cond": ["$granted", {"$subtract": ["$tokens", 1]}, "$tokens"]}}},
+            ])
+            if doc is None or doc["granted"]:
+                return
+            if doc.get("paused_until", 0) > now:
+                wait = doc["paused_until"] - now
+            elif doc["tokens"] < needed:
+                wait = (needed - doc["tokens"]) / self.rate
+            else:
+                wait = doc.get("interactive_until", 0) - now
+            # At least one token's worth, jittered, so waiting workers do not poll in lockstep
+            wait = max(wait, 1 / self.rate) + random.uniform(0, 1 / self.rate)
+            await asyncio.sleep(min(wait, 1.0))
+
+    async def debit(self) -> None:
+        now = time.time()
+        await self._update([
+            self._refill(now),
+            {"$set": {
+                # Debt is capped at one burst so a spike cannot stall background work for long
+                "tokens": {"$max": [-self.burst, {"$subtract": ["$tokens", 1]}]},
+                "interactive_until": {"$cond": [
+                    {"$lt": ["$tokens", 1]}, now + self.interactive_hold, {"$ifNull": ["$interactive_until", 0]},
+                ]},
+            }},
+        ])
+
+    def debit_later(self) -> None:
+        """`debit` without waiting for it (the caller's request is already admitted)."""
+        task = asyncio.create_task(self.debit())
+        # The event loop only keeps weak references to tasks
+        self.debits.add(task)
+        task.add_done_callback(self.debits.discard)
+
+    async def throttle(self, retry_after: Optional[float]) -> None:
+        now = time.time()
+        await self._update({
+            "$set": {"tokens": 0, "refilled_at": now},
+            "$max": {"paused_until": now + (retry_after or 0)},
+        })
+
+def _resolve(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+_limiters: Dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+_shared_backend: Optional[Tuple[Callable[[], Any], bool]] = None
+
+def _attach_shared(rate_limiter: RateLimiter) -> None:
+    if _shared_backend is not None:
+        collection, is_async = _shared_backend
+        rate_limiter.shared = SharedBucket(rate_limiter.name, rate_limiter.rate, rate_limiter.burst, collection, is_async)
+
+def limiter(name: str) -> RateLimiter:
+    """The process's limiter for an upstream ("openai", "places", ...)."""
+    with _limiters_lock:
+        if name not in _limiters:
+            rate, burst, concurrency = UPSTREAM_DEFAULTS.get(name, (5.0, 10, 10))
+            prefix = f"RATE_LIMIT_{name.upper()}"
+            _limiters[name] = RateLimiter(
+                name,
+                rate=float(os.getenv(f"{prefix}_RPS", str(rate))),
+                burst=int(os.getenv(f"{prefix}_BURST", str(burst))),
+                max_concurrency=int(os.getenv(f"{prefix}_CONCURRENCY", str(concurrency))),
+            )
+            _attach_shared(_limiters[name])
+        return _limiters[name]
+
+def share_limits(is_async: bool) -> None:
+    """
+    Puts every limiter (existing and future) on the cross-process buckets in
+    the `rate_limits` collection, using this process's motor client
+    (`is_async`, the web app) or pymongo client (the worker). Without this
+    call, limits are per process. RATE_LIMIT_SHARED=false turns it off.
+    """
+    global _shared_backend
+    if not RATE_LIMIT_SHARED:
+        return
+    get_client = get_async_client if is_async else get_sync_client
+    with _limiters_lock:
+        _shared_backend = (lambda: get_client()[CHAT_DB_NAME][RATE_LIMITS_COLLECTION_NAME], is_async)
+        for rate_limiter in _limiters.values():
+            _attach_shared(rate_limiter)
+
+def limiter_stats() -> Dict[str, Dict[str, Any]]:
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {name: rate_limiter.info() for name, rate_limiter in limiters.items()}
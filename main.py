@@ -1,3 +1,4 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from starlette.middleware.sessions import SessionMiddleware
 from fastapi.staticfiles import StaticFiles
@@ -5,12 +6,26 @@ from fastapi.templating import Jinja2Templates
 from dotenv import load_dotenv
 import os
 from app.routes import router as chatbot_router
+from common.db import get_async_client, close_clients
+from common.indexes import ensure_indexes_async
+from common.ratelimit import share_limits
 
 # Load environment variables from .env
 load_dotenv()
 
+# One pooled Mongo client per process: opened at startup, closed at shutdown.
+# Index provisioning is idempotent, so every app start re-checks it.
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    get_async_client()
+    # Chat turns share the OpenAI budget with the pipeline workers
+    share_limits(is_async=True)
+    await ensure_indexes_async()
+    yield
+    close_clients()
+
 # Initialize FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Session middleware for storing session UUIDs
 app.add_middleware(SessionMiddleware, secret_key=os.getenv("FASTAPI_SECRET_KEY", "supersecretkey"))
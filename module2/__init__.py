@@ -4,11 +4,15 @@
 Module 2: Application Extraction and Company Search
 
 This module is responsible for:
-1. Fetching the latest chatbot conversation from MongoDB.
+1. Fetching a chatbot conversation (by session, or the latest) from MongoDB.
 2. Extracting granular product-level application areas using GPT.
 3. Generating Google search queries for those applications.
 4. Using Google Places API to find relevant companies.
-5. Storing the results back into MongoDB.
+5. Ranking them per application (module2.ranking) within the search radius.
+6. Storing the results back into MongoDB.
+
+Runs are queued per session in `pipeline_jobs` (module2.jobs) and executed by
+the worker: `python -m module2.worker`.
 """
 
 from .engine import main as run_search_pipeline
@@ -0,0 +1,42 @@
+import os
+from typing import Dict, FrozenSet, List
+
+from .planner import jaccard, term_tokens
+
+# Jaccard similarity of content-word sets at or above which two extracted
+# applications are searched as one (1.0 = only identical word sets)
+APP_CLUSTER_THRESHOLD = float(os.getenv("APP_CLUSTER_THRESHOLD", "0.7"))
+
+# Function words carry no meaning in an application phrase, but make up a
+# large share of its tokens, so they would inflate similarity
+STOPWORDS = frozenset({
+    "a", "an", "and", "as", "at", "by", "for", "from", "in", "into", "of",
+    "on", "or", "the", "to", "used", "using", "via", "with",
+})
+
+def application_tokens(application: str) -> FrozenSet[str]:
+    return frozenset(term_tokens(application) - STOPWORDS)
+
+def cluster_applications(applications: List[str], threshold: float = APP_CLUSTER_THRESHOLD) -> Dict[str, List[str]]:
+    """
+    Groups near-duplicate applications: representative -> the other members
+    of its cluster, in extraction order. Greedy leader clustering: each
+    application joins the most similar existing representative at or above
+    `threshold` (comparing against representatives only, so clusters do not
+    chain), otherwise it starts a cluster of its own.
+    """
+    clusters: Dict[str, List[str]] = {}
+    leaders: List[tuple] = []  # (representative, its tokens)
+    for application in dict.fromkeys(applications):
+        tokens = application_tokens(application)
+        best, best_score = None, threshold
+        for representative, rep_tokens in leaders:
+            score = jaccard(tokens, rep_tokens)
+            if score >= best_score:
+                best, best_score = representative, score
+        if best is None:
+            leaders.append((application, tokens))
+            clusters[application] = []
+        else:
+            clusters[best].append(application)
+    return clusters
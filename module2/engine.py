@@ -1,14 +1,34 @@
 import os
 import json
+from datetime import datetime
+import asyncio
 import logging
-import requests
-from typing import List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 from dotenv import load_dotenv
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, TypeAdapter
+from openai import AsyncOpenAI
 from pydantic_ai import Agent
-from pymongo import MongoClient
+from pydantic_ai.models.openai import OpenAIModel
+from pydantic_ai.providers.openai import OpenAIProvider
+from pymongo import UpdateOne
 from pymongo.collection import Collection
 
+from common.db import (
+    get_sync_client, MONGO_URL, CHAT_DB_NAME, SESSIONS_COLLECTION_NAME,
+    RESULTS_DB_NAME, RESULTS_COLLECTION_NAME, COMPANIES_COLLECTION_NAME,
+)
+from common.indexes import ensure_indexes
+from common.llm_cache import llm_cache, llm_key
+from common.ratelimit import limiter
+from common.cache import content_key
+from .places import FIELD_MASK, MAX_PAGES, PLACES_MIN_NEW_IDS, SEARCH_RADIUS_KM, PlacesClient, places_cache
+from .geocode import get_lat_lng_from_location
+from .planner import QueryPlanner
+from .clusters import cluster_applications
+from .ranking import RANK_TOP_K, RANK_WEIGHTS, rank_places
+from .stages import StageMemo
+from .jobs import JobProgress
+
 # ------------------ Logging ------------------
 logging.basicConfig(
     filename='log.txt',
@@ -22,20 +42,31 @@ load_dotenv()
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 GOOGLE_PLACES_API_KEY = os.getenv("GOOGLE_PLACES_API_KEY")
-MONGODB_URL = os.getenv("MONGODB_URL")
-MONGO_DB_NAME = os.getenv("MONGO_DB_NAME")
-MONGO_COLLECTION_NAME = os.getenv("MONGO_COLLECTION_NAME")
+COMPANY_BATCH_SIZE = int(os.getenv("COMPANY_BATCH_SIZE", "500"))
+PLACES_CONCURRENCY = int(os.getenv("PLACES_CONCURRENCY", "10"))
+TERMS_CONCURRENCY = int(os.getenv("TERMS_CONCURRENCY", "5"))
+# Applications per term-generation call (1 = one call per application)
+TERMS_BATCH_SIZE = int(os.getenv("TERMS_BATCH_SIZE", "5"))
+# Finished applications written to MongoDB per batch, and the longest one
+# waits for its batch to fill before it is written anyway
+RESULT_BATCH_SIZE = int(os.getenv("RESULT_BATCH_SIZE", "10"))
+RESULT_FLUSH_SECONDS = float(os.getenv("RESULT_FLUSH_SECONDS", "2"))
+# One <session_uuid>.json per run, so concurrent worker jobs never share a file
+OUTPUT_DIR = os.getenv("PIPELINE_OUTPUT_DIR", "output")
 
 
 assert OPENAI_API_KEY, "Missing OpenAI API Key!"
 assert GOOGLE_PLACES_API_KEY, "Missing Google Places API Key!"
-assert MONGODB_URL, "Missing MongoDB URL!"
+assert MONGO_URL, "Missing MongoDB URL!"
 
 # ------------------ MongoDB Utilities ------------------
+# Every helper hands out collections of the one pooled client in common.db
 def get_mongo_collection() -> Collection:
-    client = MongoClient(MONGODB_URL)
-    db = client[MONGO_DB_NAME]
-    return db[MONGO_COLLECTION_NAME]
+    return get_sync_client()[RESULTS_DB_NAME][RESULTS_COLLECTION_NAME]
+
+def get_companies_collection(results: Collection) -> Collection:
+    """Companies live in the same database as the application results."""
+    return results.database[COMPANIES_COLLECTION_NAME]
 
 # ------------------ Pydantic Models ------------------
 class ConversationEntry(BaseModel):
@@ -56,6 +87,7 @@ class Location(BaseModel):
     longitude: Optional[float] = None
 
 class Place(BaseModel):
+    id: Optional[str] = None
     displayName: Optional[DisplayName] = None
     formattedAddress: Optional[str] = None
     location: Optional[Location] = None
@@ -68,12 +100,23 @@ class Place(BaseModel):
     internationalPhoneNumber: Optional[str] = None
     rating: Optional[float] = None
     userRatingCount: Optional[int] = Field(None, alias="userRatingCount")
+    # Set by module2.ranking for this application's search
+    score: Optional[float] = None
+    termHits: Optional[int] = None
+    distanceKm: Optional[float] = None
+
+class ApplicationSearchTerms(BaseModel):
+    index: int = Field(..., description="the application's number in the list")
+    application: str
+    search_terms: List[str]
 
 class SearchQueryEntry(BaseModel):
     application: str
     google_search_terms: List[str]
-    matched_places: List[Place]
+    matched_places: List[Place]  # ranked, best first
     status: str  # "OK", "ZERO_RESULTS", or "ERROR"
+    candidate_count: int = 0  # open places found before the radius filter and top-k
+    cluster_members: List[str] = []  # near-duplicate applications searched as this one
 
 class SearchQueryResults(BaseModel):
     extracted_applications: List[str]
@@ -81,18 +124,22 @@ class SearchQueryResults(BaseModel):
 
 # ------------------ MongoDB Access ------------------
 def get_mongo_client():
-    return MongoClient(MONGODB_URL)
+    return get_sync_client()
 
-def fetch_latest_session_from_mongo() -> Optional[List[ConversationEntry]]:
+def fetch_session_from_mongo(session_uuid: Optional[str] = None) -> Tuple[Optional[str], Optional[List[ConversationEntry]]]:
+    """(session_uuid, Q&A pairs) of the given session, or of the latest one when no uuid is given."""
     client = get_mongo_client()
-    db = client["chatbot_db"]  # explicitly use the correct DB
-    collection = db["chat_sessions"]  # explicitly use the correct collection
+    db = client[CHAT_DB_NAME]  # explicitly use the correct DB
+    collection = db[SESSIONS_COLLECTION_NAME]  # explicitly use the correct collection
 
-    latest_session = collection.find_one(sort=[("_id", -1)])
-    if not latest_session or "messages" not in latest_session:
-        return None
+    if session_uuid:
+        session = collection.find_one({"session_uuid": session_uuid})
+    else:
+        session = collection.find_one(sort=[("_id", -1)])
+    if not session or "messages" not in session:
+        return session_uuid, None
 
-    messages = latest_session["messages"]
+    messages = session["messages"]
     qa_pairs = []
 
     for i in range(0, len(messages) - 1):
@@ -104,9 +151,40 @@ def fetch_latest_session_from_mongo() -> Optional[List[ConversationEntry]]:
                 answer=next_msg.get("answer", "")
             ))
 
-    return qa_pairs if qa_pairs else None
+    return session.get("session_uuid"), qa_pairs if qa_pairs else None
 
 
+# ------------------ LLM Calls ------------------
+ENGINE_MODEL = "openai:gpt-3.5-turbo"
+openai_limiter = limiter("openai")
+
+def engine_model() -> OpenAIModel:
+    """
+    ENGINE_MODEL with the OpenAI SDK's own retries off: throttled calls
+    must reach openai_limiter (AIMD + shared backoff), not be absorbed by
+    silent SDK retries. app/gpt.py does the same for chat.
+    """
+    client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+    return OpenAIModel(ENGINE_MODEL.split(":", 1)[1], provider=OpenAIProvider(openai_client=client))
+
+async def run_agent_cached(agent: Agent, prompt: str, output_type: Any) -> Any:
+    """
+    (await agent.run(prompt, output_type=...)).output, served from the shared
+    LLM cache when the same (model, prompt, output schema) was seen before.
+    """
+    adapter = TypeAdapter(output_type)
+    key = llm_key(ENGINE_MODEL, prompt, output_type=adapter.json_schema())
+    if key:
+        cached = await asyncio.to_thread(llm_cache.get, key)
+        if cached is not None:
+            return adapter.validate_python(cached)
+
+    # Background priority: live chat turns go first on the shared OpenAI limiter
+    output = (await openai_limiter.call(lambda: agent.run(prompt, output_type=output_type))).output
+    if key:
+        await asyncio.to_thread(llm_cache.set, key, adapter.dump_python(output, mode="json"))
+    return output
+
 # ------------------ Utility Functions ------------------
 def json_to_chatml(conversation_log: ConversationLog) -> str:
     chatml_lines = []
@@ -132,114 +210,14 @@ def extract_user_location(conversation_entries: List[ConversationEntry]) -> Opti
                     return match.group(2).strip()
     return None
 
-def get_lat_lng_from_location(location_name: str) -> Optional[Tuple[float, float]]:
-    """
-    Uses Google Geocoding API to get lat/lng for a location name
-    """
-    geocode_url = "https://maps.googleapis.com/maps/api/geocode/json"
-    params = {
-        "address": location_name,
-        "key": GOOGLE_PLACES_API_KEY
-    }
-    try:
-        response = requests.get(geocode_url, params=params, timeout=10)
-        data = response.json()
-        if data.get("status") == "OK":
-            loc = data["results"][0]["geometry"]["location"]
-            return loc["lat"], loc["lng"]
-    except Exception as e:
-        logging.error(f"Error in geocoding location '{location_name}': {e}")
-    return None
-
-def search_google_places(query: str, location: Optional[Tuple[float, float]] = None, radius: int = 50000) -> Tuple[List[dict], str]:
-    endpoint = "https://places.googleapis.com/v1/places:searchText"
-    headers = {
-        "Content-Type": "application/json",
-        "X-Goog-Api-Key": GOOGLE_PLACES_API_KEY,
-        "X-Goog-FieldMask": ",".join([
-            "places.id",
-            "places.displayName",
-            "places.formattedAddress",
-            "places.location",
-            "places.primaryType",
-            "places.types",
-            "places.businessStatus",
-            "places.googleMapsUri",
-            "places.websiteUri",
-            "places.nationalPhoneNumber",
-            "places.internationalPhoneNumber",
-            "places.rating",
-            "places.userRatingCount"
-        ])
-    }
-
-    payload = {
-        "textQuery": query,
-        "maxResultCount": 20
-    }
-
-    if location:
-        lat, lng = location
-
-        # Define a bounding box around the location
-        delta = 0.5  # roughly ~50 km radius (tweak if needed)
-        min_lat = lat - delta
-        max_lat = lat + delta
-        min_lng = lng - delta
-        max_lng = lng + delta
-
-        payload["locationRestriction"] = {
-            "rectangle": {
-                "minLatitude": min_lat,
-                "maxLatitude": max_lat,
-                "minLongitude": min_lng,
-                "maxLongitude": max_lng
-            }
-        }
-
-
-
-
+# ------------------ Stages ------------------
+# extract -> location -> terms -> search -> rank -> persist. Every stage's
+# output is memoized (module2.stages) on a hash of its inputs, so a re-run
+# only recomputes the stages and applications whose inputs changed; persist
+# compares against the hash stored on the result document instead.
 
-    all_results = []
-    try:
-        for _ in range(3):  # Max 3 pages
-            response = requests.post(endpoint, headers=headers, json=payload, timeout=10)
-            data = response.json()
-
-            places = data.get("places", [])
-            all_results.extend(places)
-
-            next_page_token = data.get("nextPageToken")
-            if not next_page_token:
-                break
-
-            import time
-            time.sleep(2)
-            payload["pageToken"] = next_page_token
-
-    except Exception as e:
-        logging.error(f"Google Places API Exception | Query: '{query}' | Exception: {e}")
-        return all_results, "ERROR"
-
-    return all_results, "OK"
-
-# ------------------ Main ------------------
-def main():
-    conversation_entries = fetch_latest_session_from_mongo()
-    if not conversation_entries:
-        print("No valid session or qa_items found.")
-        return
-
-    conv_log = ConversationLog(conversation=conversation_entries)
-    chatml_conversation = json_to_chatml(conv_log)
-
-    user_location = extract_user_location(conversation_entries)
-    coords = get_lat_lng_from_location(user_location) if user_location else None
-    if coords:
-        logging.info(f"User location: {user_location} → {coords}")
-
-    application_prompt = f"""
+def application_prompt(chatml_conversation: str) -> str:
+    return f"""
     You are given a ChatML conversation about a product. Your task is to extract ONLY extremely specific, product-level, real-world application areas of the product discussed.
 
     EXTREMELY STRICT GUIDELINES:
@@ -262,16 +240,9 @@ def main():
 
     {chatml_conversation}
     """
-    agent = Agent("openai:gpt-3.5-turbo")
 
-    # Stage 1: Application Extraction
-    result = agent.run_sync(application_prompt, output_type=PredictionResult)
-    applications = result.output.predicted_interests
-
-    # Stage 2: Search per application
-    search_results = []
-    for app in applications:
-        search_prompt = f"""
+def search_terms_prompt(app: str) -> str:
+    return f"""
         You are a B2B technical sales researcher.
 
         APPLICATION: {app}
@@ -287,87 +258,473 @@ def main():
         Return ONLY a list like this:
         ["<search 1>", "<search 2>", "<search 3>", "<search 4>"]
         """
+
+async def extract_applications(memo: StageMemo, agent: Agent, chatml_conversation: str) -> List[str]:
+    prompt = application_prompt(chatml_conversation)
+
+    async def compute() -> List[str]:
+        return (await run_agent_cached(agent, prompt, PredictionResult)).predicted_interests
+
+    return await memo.run("extract", (ENGINE_MODEL, prompt), compute)
+
+async def resolve_location(memo: StageMemo, conversation_entries: List[ConversationEntry]) -> Optional[Tuple[float, float]]:
+    user_location = extract_user_location(conversation_entries)
+    if not user_location:
+        return None
+
+    async def compute() -> dict:
+        coords = await asyncio.to_thread(get_lat_lng_from_location, user_location, GOOGLE_PLACES_API_KEY)
+        return {"name": user_location, "coords": list(coords) if coords else None}
+
+    # Misses are left to the geocode cache's shorter negative TTL
+    located = await memo.run("location", user_location, compute, cacheable=lambda found: found["coords"] is not None)
+    if not located["coords"]:
+        return None
+    coords = tuple(located["coords"])
+    logging.info(f"User location: {user_location} → {coords}")
+    return coords
+
+async def request_search_terms(agent: Agent, app: str, semaphore: asyncio.Semaphore) -> List[str]:
+    async with semaphore:
         try:
-            search_result = agent.run_sync(search_prompt, output_type=List[str])
-            search_terms = search_result.output
+            return await run_agent_cached(agent, search_terms_prompt(app), List[str])
         except Exception as e:
             logging.error(f"Search term error for '{app}': {e}")
-            search_terms = []
-
-        all_places = []
-        final_status = "ZERO_RESULTS"
-        for term in search_terms:
-            places, status = search_google_places(term, location=coords)
-            if status == "OK" and places:
-                final_status = "OK"
-            elif status == "ERROR":
-                final_status = "ERROR"
-            all_places.extend(places)
-
-        unique_places = {}
-        for place in all_places:
-            if place.get("businessStatus") != "CLOSED_PERMANENTLY":
-                place_id = place.get("id")
-                if place_id and place_id not in unique_places:
-                    unique_places[place_id] = place
-
-        search_results.append(SearchQueryEntry(
-            application=app,
-            google_search_terms=search_terms,
-            matched_places=[Place(**p) for p in unique_places.values()],
-            status=final_status
-        ))
+            return []
+
+async def generate_search_terms(memo: StageMemo, agent: Agent, app: str, semaphore: asyncio.Semaphore) -> List[str]:
+    return await memo.run(
+        "terms", (ENGINE_MODEL, search_terms_prompt(app)),
+        lambda: request_search_terms(agent, app, semaphore),
+        cacheable=bool,
+    )
+
+def batch_search_terms_prompt(apps: List[str]) -> str:
+    numbered = "\n".join(f"        {i}. {app}" for i, app in enumerate(apps, 1))
+    return f"""
+        You are a B2B technical sales researcher.
+
+        APPLICATIONS:
+{numbered}
+
+        TASK:
+        For EACH application above, generate atleast 20 highly effective Google search phrases as possible to find companies, manufacturers, OEMs, or research labs involved in that application. Focus on the material, process, and functional role.
+
+        USE THESE GUIDELINES:
+        - Include modifiers like: "supplier", "manufacturer", "OEM", "compounder"
+        - Focus only on search terms that would be effective on Google.
+        - Keep every application's phrases specific to that application.
+
+        FORMAT:
+        Return one entry per application with its number, the application text exactly as given, and its search phrases.
+        """
+
+class TermBatcher:
+    """
+    Stage 2 in chunks: up to `batch_size` applications share one
+    structured-output call (ApplicationSearchTerms per application).
+    Applications the response leaves out or returns without terms fall back
+    to their own call (request_search_terms). Results are memoized under
+    the same per-application key as the unbatched path, so both modes share
+    the stage cache. `await batcher.terms(app)` resolves when app's chunk does.
+    """
+
+    def __init__(self, memo: StageMemo, agent: Agent, applications: List[str], semaphore: asyncio.Semaphore, batch_size: int = TERMS_BATCH_SIZE):
+        self.memo = memo
+        self.agent = agent
+        self.semaphore = semaphore
+        self.batch_size = max(1, batch_size)
+        self.chunk_of: Dict[str, int] = {}
+        self.chunks: List[List[str]] = []
+        unique = list(dict.fromkeys(applications))
+        for start in range(0, len(unique), self.batch_size):
+            chunk = unique[start:start + self.batch_size]
+            for app in chunk:
+                self.chunk_of[app] = len(self.chunks)
+            self.chunks.append(chunk)
+        self.tasks: Dict[int, asyncio.Task] = {}
+        self.stats = {"batch_calls": 0, "batched_applications": 0, "fallback_calls": 0}
+
+    async def terms(self, app: str) -> List[str]:
+        if self.batch_size == 1 or app not in self.chunk_of:
+            return await generate_search_terms(self.memo, self.agent, app, self.semaphore)
+        index = self.chunk_of[app]
+        if index not in self.tasks:
+            self.tasks[index] = asyncio.create_task(self.run_chunk(self.chunks[index]))
+        return (await asyncio.shield(self.tasks[index])).get(app, [])
+
+    async def run_chunk(self, chunk: List[str]) -> Dict[str, List[str]]:
+        results: Dict[str, List[str]] = {}
+        pending = []
+        for app in chunk:
+            cached = await self.memo.lookup("terms", (ENGINE_MODEL, search_terms_prompt(app)))
+            if cached is not None:
+                results[app] = cached
+            else:
+                pending.append(app)
+
+        if len(pending) > 1:
+            batched = await self.call_batch(pending)
+            for app in pending:
+                if batched.get(app):
+                    results[app] = batched[app]
+                    await self.memo.store("terms", (ENGINE_MODEL, search_terms_prompt(app)), batched[app])
+            self.stats["batch_calls"] += 1
+            self.stats["batched_applications"] += len(batched)
+
+        missing = [app for app in pending if app not in results]
+        if len(pending) > 1:
+            self.stats["fallback_calls"] += len(missing)
+        fallbacks = await asyncio.gather(*(request_search_terms(self.agent, app, self.semaphore) for app in missing))
+        for app, terms in zip(missing, fallbacks):
+            results[app] = terms
+            if terms:
+                await self.memo.store("terms", (ENGINE_MODEL, search_terms_prompt(app)), terms)
+        return results
+
+    async def call_batch(self, apps: List[str]) -> Dict[str, List[str]]:
+        """app -> terms for every application the response covered with at least one term."""
+        async with self.semaphore:
+            try:
+                entries = await run_agent_cached(self.agent, batch_search_terms_prompt(apps), List[ApplicationSearchTerms])
+            except Exception as e:
+                logging.error(f"Batched search term error for {len(apps)} applications: {e}")
+                return {}
+
+        by_text = {app.strip().lower(): app for app in apps}
+        batched: Dict[str, List[str]] = {}
+        for entry in entries:
+            # Prefer the number; fall back to the echoed text if the number is off
+            app = apps[entry.index - 1] if 1 <= entry.index <= len(apps) else None
+            if app is None or app in batched:
+                app = by_text.get(entry.application.strip().lower())
+            terms = [term.strip() for term in entry.search_terms if term and term.strip()]
+            if app and app not in batched and terms:
+                batched[app] = terms
+        return batched
+
+async def search_application(planner: QueryPlanner, app: str, search_terms: List[str]) -> dict:
+    """
+    Open places found by any of the terms (unique by id), term hits per
+    place and the overall status.
+    """
+    responses = await planner.search_terms(search_terms, app)
+
+    final_status = "ZERO_RESULTS"
+    unique_places = {}
+    term_hits = {}  # place id -> how many of this application's terms found it
+    for places_found, status in responses:
+        if status == "OK" and places_found:
+            final_status = "OK"
+        elif status == "ERROR":
+            final_status = "ERROR"
+        found_ids = set()
+        for place in places_found:
+            place_id = place.get("id")
+            if place_id and place.get("businessStatus") != "CLOSED_PERMANENTLY":
+                unique_places.setdefault(place_id, place)
+                found_ids.add(place_id)
+        for place_id in found_ids:
+            term_hits[place_id] = term_hits.get(place_id, 0) + 1
+
+    return {"places": list(unique_places.values()), "term_hits": term_hits, "status": final_status}
+
+async def process_application(
+    memo: StageMemo,
+    batcher: TermBatcher,
+    planner: QueryPlanner,
+    app: str,
+    members: List[str],
+    sink: "ResultSink",
+) -> None:
+    """Terms, search and rank for one application, then straight to the sink."""
+    search_terms = await batcher.terms(app)
+
+    # The result depends only on these inputs (see QueryPlanner); failed
+    # searches are not remembered so they are retried next run
+    search_inputs = (
+        search_terms, planner.location, SEARCH_RADIUS_KM, FIELD_MASK, MAX_PAGES,
+        PLACES_MIN_NEW_IDS, planner.threshold,
+    )
+    found = await memo.run(
+        "search", search_inputs,
+        lambda: search_application(planner, app, search_terms),
+        cacheable=lambda found: found["status"] != "ERROR",
+    )
 
-    final_output = SearchQueryResults(
-        extracted_applications=applications,
-        targeting_keywords=search_results
+    async def rank() -> List[dict]:
+        return rank_places(found["places"], found["term_hits"], search_terms, app, origin=planner.location)
+
+    # Keyed on the places actually ranked, so a recomputed search never
+    # gets a ranking of some earlier result
+    rank_inputs = (app, search_terms, planner.location, SEARCH_RADIUS_KM, RANK_TOP_K, RANK_WEIGHTS, content_key(found))
+    ranked = await memo.run("rank", rank_inputs, rank)
+
+    entry = SearchQueryEntry(
+        application=app,
+        google_search_terms=search_terms,
+        matched_places=[Place(**p) for p in ranked],
+        status=found["status"],
+        candidate_count=len(found["places"]),
+        cluster_members=members,
     )
+    await sink.emit(entry)
+
+# ------------------ Output ------------------
+def company_info(company: Place) -> dict:
+    return {
+        "name": company.displayName.text if company.displayName else None,
+        "address": company.formattedAddress,
+        "location": {
+            "latitude": company.location.latitude if company.location else None,
+            "longitude": company.location.longitude if company.location else None
+        },
+        "phone": {
+            "national": company.nationalPhoneNumber,
+            "international": company.internationalPhoneNumber,
+        },
+        "website": company.websiteURL,
+        "google_maps_url": company.googleMapsURL,
+        "rating": company.rating,
+        "user_rating_count": company.userRatingCount,
+        "types": company.types or [],
+        "status": company.businessStatus
+    }
 
-    print(final_output.model_dump_json(indent=2))
-    with open('output.json', 'w', encoding='utf-8') as f:
-        f.write(final_output.model_dump_json(indent=2))
-            
-    client = MongoClient(MONGODB_URL)
-    db = client[MONGO_DB_NAME]
-    collection = db[MONGO_COLLECTION_NAME]
-
-    for app_block in final_output.targeting_keywords:
-        application_name = app_block.application
-        search_terms = app_block.google_search_terms
-        matched_places = app_block.matched_places
-
-        doc = {
-            "application": application_name,
-            "search_terms": search_terms,
-            "companies": []
-        }
-
-        for company in matched_places:
-            company_info = {
-                "name": company.displayName.text if company.displayName else None,
-                "address": company.formattedAddress,
-                "location": {
-                    "latitude": company.location.latitude if company.location else None,
-                    "longitude": company.location.longitude if company.location else None
+def persist_entries(results: Collection, companies: Collection, entries: List[SearchQueryEntry], session_uuid: Optional[str]) -> List[bool]:
+    """
+    Writes a batch of application entries: one find for the stored hashes,
+    then the company upserts and the result upserts, each through
+    bulk_write. Companies are stored once, keyed by Places id (`_id`),
+    with the applications that matched them, so a company found by several
+    applications of the batch is upserted once; the application documents
+    only reference company ids.
+
+    An entry the stored document already holds, as recorded by its
+    `content_hash`, is skipped. Returns, per entry, whether it was written.
+    """
+    hashes = [content_key(session_uuid, entry.model_dump(mode="json")) for entry in entries]
+    stored = {
+        doc["application"]: doc.get("content_hash")
+        for doc in results.find(
+            {"session_uuid": session_uuid, "application": {"$in": [entry.application for entry in entries]}},
+            {"application": 1, "content_hash": 1},
+        )
+    }
+    written = [stored.get(entry.application) != content_hash for entry, content_hash in zip(entries, hashes)]
+
+    now = datetime.now()
+    company_updates: Dict[str, dict] = {}  # Places id -> (info, applications), merged across the batch
+    result_operations = []
+    for entry, content_hash, write in zip(entries, hashes, written):
+        if not write:
+            continue
+        company_ids = []
+        for company in entry.matched_places:
+            if not company.id:
+                continue
+            company_ids.append(company.id)
+            update = company_updates.setdefault(company.id, {"info": company_info(company), "applications": []})
+            update["applications"].extend([entry.application, *entry.cluster_members])
+
+        result_operations.append(UpdateOne(
+            {"session_uuid": session_uuid, "application": entry.application},
+            {
+                "$set": {
+                    "session_uuid": session_uuid,
+                    "application": entry.application,
+                    "search_terms": entry.google_search_terms,
+                    "status": entry.status,
+                    "company_ids": company_ids,  # ranked, best first
+                    "company_scores": [company.score for company in entry.matched_places if company.id],
+                    "candidate_count": entry.candidate_count,
+                    "cluster_members": entry.cluster_members,
+                    "content_hash": content_hash,
+                    "updated_at": now,
                 },
-                "phone": {
-                    "national": company.nationalPhoneNumber,
-                    "international": company.internationalPhoneNumber,
+                "$unset": {"companies": ""},
+            },
+            upsert=True,
+        ))
+
+    company_operations = [
+        UpdateOne(
+            {"_id": company_id},
+            {
+                "$set": {**update["info"], "updated_at": now},
+                "$addToSet": {
+                    "applications": {"$each": list(dict.fromkeys(update["applications"]))},
+                    "sessions": session_uuid,
                 },
-                "website": company.websiteURL,
-                "google_maps_url": company.googleMapsURL,
-                "rating": company.rating,
-                "user_rating_count": company.userRatingCount,
-                "types": company.types or [],
-                "status": company.businessStatus
-            }
-            doc["companies"].append(company_info)
-
-        # Insert or update into MongoDB
-        collection.update_one(
-            {"application": application_name},
-            {"$set": doc},
-            upsert=True
+                "$setOnInsert": {"created_at": now},
+            },
+            upsert=True,
         )
+        for company_id, update in company_updates.items()
+    ]
+    for start in range(0, len(company_operations), COMPANY_BATCH_SIZE):
+        companies.bulk_write(company_operations[start:start + COMPANY_BATCH_SIZE], ordered=False)
+
+    # After their companies, so every reference resolves
+    if result_operations:
+        results.bulk_write(result_operations, ordered=False)
+    return written
+
+class OutputWriter:
+    """
+    Streams a run's output file in the SearchQueryResults shape: the
+    applications first, then each SearchQueryEntry as soon as it completes
+    (completion order), so no run ever holds the whole result set in
+    memory. Entries go to a private temporary file that replaces `path`
+    on close, so readers only ever see complete JSON.
+    """
+
+    def __init__(self, path: str, applications: List[str]):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.tmp_path = f"{path}.{os.getpid()}.{id(self)}.tmp"
+        self.file = open(self.tmp_path, "w", encoding="utf-8")
+        self.count = 0
+        applications_json = json.dumps(applications, indent=2, ensure_ascii=False).replace("\n", "\n  ")
+        self.file.write(f'{{\n  "extracted_applications": {applications_json},\n  "targeting_keywords": [')
+
+    def write(self, entry: SearchQueryEntry) -> None:
+        separator = "," if self.count else ""
+        self.file.write(separator + "\n    " + entry.model_dump_json(indent=2).replace("\n", "\n    "))
+        self.file.flush()
+        self.count += 1
+
+    def close(self) -> None:
+        self.file.write("\n  ]\n}" if self.count else "]\n}")
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+def output_path(session_uuid: str) -> str:
+    return os.path.join(OUTPUT_DIR, f"{session_uuid}.json")
+
+class ResultSink:
+    """
+    Where each finished application goes: the run's output file at once,
+    then MongoDB and job progress in batches of RESULT_BATCH_SIZE, or after
+    RESULT_FLUSH_SECONDS, whichever comes first, so results keep streaming
+    to the completion page. `close()` flushes what is left.
+    """
+
+    def __init__(
+        self,
+        collection: Collection,
+        session_uuid: Optional[str],
+        writer: OutputWriter,
+        progress: Optional[JobProgress],
+        memo: StageMemo,
+    ):
+        self.collection = collection
+        self.companies = get_companies_collection(collection)
+        self.session_uuid = session_uuid
+        self.writer = writer
+        self.progress = progress
+        self.memo = memo
+        self.pending: List[SearchQueryEntry] = []
+        self.timer: Optional[asyncio.Task] = None
+        self.error: Optional[Exception] = None
+
+    async def emit(self, entry: SearchQueryEntry) -> None:
+        self.writer.write(entry)
+        self.pending.append(entry)
+        print(f" {entry.application}: {len(entry.matched_places)} of {entry.candidate_count} companies ({entry.status})")
+        if len(self.pending) >= RESULT_BATCH_SIZE:
+            await self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.create_task(self.flush_after(RESULT_FLUSH_SECONDS))
+
+    async def flush_after(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+        self.timer = None
+        try:
+            await self.flush()
+        except Exception as e:
+            # Raised again by close(), so a failed write still fails the run
+            self.error = e
+
+    async def flush(self) -> None:
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        written = await asyncio.to_thread(persist_entries, self.collection, self.companies, batch, self.session_uuid)
+        for was_written in written:
+            self.memo.count("persist", "misses" if was_written else "hits")
+        if self.progress:
+            await self.progress.increment("search", "applications_done", len(batch))
+
+    async def close(self) -> None:
+        try:
+            await self.flush()
+        finally:
+            self.writer.close()
+        if self.error:
+            raise self.error
+
+# ------------------ Main ------------------
+async def run_pipeline(session_uuid: Optional[str] = None, progress: Optional[JobProgress] = None):
+    session_uuid, conversation_entries = fetch_session_from_mongo(session_uuid)
+    if not conversation_entries:
+        print("No valid session or qa_items found.")
+        return
+
+    conv_log = ConversationLog(conversation=conversation_entries)
+    chatml_conversation = json_to_chatml(conv_log)
+
+    agent = Agent(engine_model())
+    memo = StageMemo()
+
+    # Geocoding runs in the background while applications are extracted
+    coords_task = asyncio.create_task(resolve_location(memo, conversation_entries))
+
+    # Stage 1: Application Extraction
+    if progress:
+        await progress.report("extract", state="running")
+    applications = await extract_applications(memo, agent, chatml_conversation)
+
+    # Near-duplicate applications are searched once, by their cluster's representative
+    clusters = cluster_applications(applications)
+    fanouts_saved = len(applications) - len(clusters)
+    logging.info(f"Application clustering: {len(applications)} applications -> {len(clusters)} searches ({fanouts_saved} fan-outs saved)")
+    if progress:
+        await progress.report("extract", state="done", applications=len(applications), clusters=len(clusters), fanouts_saved=fanouts_saved)
+        await progress.report("search", state="running", applications_total=len(clusters), applications_done=0)
+
+    coords = await coords_task
+
+    # Stages 2-5: term generation (TERMS_BATCH_SIZE applications per call,
+    # TERMS_CONCURRENCY calls at a time), Places fan-out, ranking and
+    # persistence per application, all applications concurrently. Each
+    # application is written out as soon as it completes.
+    sink = ResultSink(get_mongo_collection(), session_uuid, OutputWriter(output_path(session_uuid), applications), progress, memo)
+    batcher = TermBatcher(memo, agent, list(clusters), asyncio.Semaphore(TERMS_CONCURRENCY))
+    try:
+        async with PlacesClient(GOOGLE_PLACES_API_KEY, concurrency=PLACES_CONCURRENCY) as places:
+            planner = QueryPlanner(places, coords)
+            await asyncio.gather(*(
+                process_application(memo, batcher, planner, app, members, sink) for app, members in clusters.items()
+            ))
+            logging.info(f"Places pagination: {places.stats}")
+            logging.info(f"Search term dedup: {planner.stats()}")
+            logging.info(f"Term batching: {batcher.stats}")
+    finally:
+        await sink.close()
 
     print(" Data successfully inserted/updated into MongoDB Atlas.")
+    logging.info(f"Stage memoization: {memo.stats}")
+    if progress:
+        await progress.report("search", state="done", **planner.stats())
+        await progress.report("stages", **memo.stats)
+    if places_cache:
+        logging.info(f"Places cache: {places_cache.info()}")
+
+def main(session_uuid: Optional[str] = None, progress: Optional[JobProgress] = None):
+    # Before the event loop starts; a no-op under the worker, which provisions at startup
+    ensure_indexes()
+    asyncio.run(run_pipeline(session_uuid, progress))
@@ -0,0 +1,83 @@
+import os
+import re
+import json
+import logging
+import requests
+from typing import Dict, Optional, Tuple
+
+from common.cache import TieredCache
+
+GEOCODE_URL = "https://maps.googleapis.com/maps/api/geocode/json"
+
+# Positive results barely change; names that do not resolve are retried sooner.
+GEOCODE_CACHE_TTL = float(os.getenv("GEOCODE_CACHE_TTL", str(90 * 24 * 3600)))
+GEOCODE_NEGATIVE_TTL = float(os.getenv("GEOCODE_NEGATIVE_TTL", str(24 * 3600)))
+# Optional JSON file {"city name": [lat, lng], ...} consulted before anything else
+GAZETTEER_PATH = os.getenv("GAZETTEER_PATH")
+
+geocode_cache = TieredCache("geocode", ttl=GEOCODE_CACHE_TTL, max_entries=10000)
+
+_non_word = re.compile(r"[^\w\s]+")
+_spaces = re.compile(r"\s+")
+
+def normalize_location(name: str) -> str:
+    return _spaces.sub(" ", _non_word.sub(" ", name.lower())).strip()
+
+_gazetteer: Optional[Dict[str, Tuple[float, float]]] = None
+
+def load_gazetteer() -> Dict[str, Tuple[float, float]]:
+    global _gazetteer
+    if _gazetteer is None:
+        _gazetteer = {}
+        if GAZETTEER_PATH:
+            try:
+                with open(GAZETTEER_PATH, encoding="utf-8") as f:
+                    entries = json.load(f)
+                for name, coords in entries.items():
+                    try:
+                        lat, lng = (float(value) for value in coords)
+                    except (TypeError, ValueError):
+                        # One bad entry must not cost the rest of the file (or the job)
+                        logging.warning(f"Gazetteer entry {name!r} skipped: expected [lat, lng], got {coords!r}")
+                        continue
+                    _gazetteer[normalize_location(name)] = (lat, lng)
+            except (OSError, ValueError, AttributeError) as e:
+                # AttributeError: the file is valid JSON but not an object
+                logging.error(f"Gazetteer '{GAZETTEER_PATH}' not loaded: {e}")
+    return _gazetteer
+
+def get_lat_lng_from_location(location_name: str, api_key: str) -> Optional[Tuple[float, float]]:
+    """
+    Lat/lng for a location name: local gazetteer first, then the geocode
+    cache (including remembered misses), then the Google Geocoding API.
+    """
+    name = normalize_location(location_name)
+    if not name:
+        return None
+
+    known = load_gazetteer().get(name)
+    if known:
+        return known
+
+    cached = geocode_cache.get(name)
+    if cached is not None:
+        return (cached["lat"], cached["lng"]) if cached.get("found") else None
+
+    params = {
+        "address": location_name,
+        "key": api_key
+    }
+    try:
+        response = requests.get(GEOCODE_URL, params=params, timeout=10)
+        data = response.json()
+        status = data.get("status")
+        if status == "OK":
+            loc = data["results"][0]["geometry"]["location"]
+            geocode_cache.set(name, {"found": True, "lat": loc["lat"], "lng": loc["lng"]})
+            return loc["lat"], loc["lng"]
+        if status == "ZERO_RESULTS":
+            # Negative entry; other statuses (quota, denied) are transient
+            geocode_cache.set(name, {"found": False}, ttl=GEOCODE_NEGATIVE_TTL)
+    except Exception as e:
+        logging.error(f"Error in geocoding location '{location_name}': {e}")
+    return None
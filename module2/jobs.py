@@ -0,0 +1,136 @@
+import os
+import socket
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from pymongo import ReturnDocument, ASCENDING
+from pymongo.collection import Collection
+
+from common.db import get_sync_client, CHAT_DB_NAME, JOBS_COLLECTION_NAME
+
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "300"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+
+# Job states: queued -> running -> done | failed (a failed attempt with
+# attempts left goes back to queued; an expired lease is claimable again)
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+def get_jobs_collection() -> Collection:
+    # Jobs live next to the chat sessions they were created for
+    return get_sync_client()[CHAT_DB_NAME][JOBS_COLLECTION_NAME]
+
+def worker_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def fail_exhausted_jobs(collection: Collection) -> int:
+    """
+    Marks FAILED the jobs that can never be claimed again: a lease that ran
+    out on the last attempt (the worker died), or a queued job already at
+    JOB_MAX_ATTEMPTS (e.g. after the setting was lowered).
+    """
+    now = datetime.now()
+    result = collection.update_many(
+        {
+            "$or": [
+                {"state": RUNNING, "lease_expires_at": {"$lt": now}},
+                {"state": QUEUED},
+            ],
+            "attempts": {"$gte": JOB_MAX_ATTEMPTS},
+        },
+        {"$set": {
+            "state": FAILED,
+            "error": "lease expired on the last attempt",
+            "finished_at": now,
+            "updated_at": now,
+            "lease_expires_at": None,
+        }},
+    )
+    if result.modified_count:
+        logging.warning(f"Marked {result.modified_count} job(s) with no attempts left as failed")
+    return result.modified_count
+
+def claim_job(collection: Collection, worker_id: str) -> Optional[Dict]:
+    """Atomically leases the oldest queued job, or one whose lease ran out."""
+    fail_exhausted_jobs(collection)
+    now = datetime.now()
+    return collection.find_one_and_update(
+        {
+            "$or": [
+                {"state": QUEUED},
+                {"state": RUNNING, "lease_expires_at": {"$lt": now}},
+            ],
+            "attempts": {"$lt": JOB_MAX_ATTEMPTS},
+        },
+        {
+            "$set": {
+                "state": RUNNING,
+                "worker_id": worker_id,
+                "lease_expires_at": now + timedelta(seconds=JOB_LEASE_SECONDS),
+                "started_at": now,
+                "updated_at": now,
+            },
+            "$inc": {"attempts": 1},
+        },
+        sort=[("created_at", ASCENDING)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+def renew_lease(collection: Collection, job_id: str, worker_id: str) -> bool:
+    """False when the job is no longer ours (lease lost to another worker)."""
+    now = datetime.now()
+    result = collection.update_one(
+        {"_id": job_id, "worker_id": worker_id, "state": RUNNING},
+        {"$set": {"lease_expires_at": now + timedelta(seconds=JOB_LEASE_SECONDS), "updated_at": now}},
+    )
+    return result.matched_count == 1
+
+def finish_job(collection: Collection, job: Dict, worker_id: str, error: Optional[str] = None) -> None:
+    if error is None:
+        state = DONE
+    else:
+        state = QUEUED if job.get("attempts", 1) < JOB_MAX_ATTEMPTS else FAILED
+    collection.update_one(
+        {"_id": job["_id"], "worker_id": worker_id},
+        {"$set": {
+            "state": state,
+            "error": error,
+            "finished_at": datetime.now(),
+            "updated_at": datetime.now(),
+            "lease_expires_at": None,
+        }},
+    )
+
+class JobProgress:
+    """Per-stage progress written to `progress.<stage>` on the job document."""
+
+    def __init__(self, collection: Collection, job_id: str):
+        self.collection = collection
+        self.job_id = job_id
+
+    def update(self, stage: str, **fields) -> None:
+        now = datetime.now()
+        values = {f"progress.{stage}.{key}": value for key, value in fields.items()}
+        values[f"progress.{stage}.updated_at"] = now
+        values["updated_at"] = now
+        try:
+            self.collection.update_one({"_id": self.job_id}, {"$set": values})
+        except Exception as e:
+            # Progress is informational; never fail the pipeline over it
+            logging.error(f"Job progress update failed for {self.job_id}: {e}")
+
+    def inc(self, stage: str, counter: str, amount: int = 1) -> None:
+        try:
+            self.collection.update_one(
+                {"_id": self.job_id},
+                {"$inc": {f"progress.{stage}.{counter}": amount}, "$set": {"updated_at": datetime.now()}},
+            )
+        except Exception as e:
+            logging.error(f"Job progress update failed for {self.job_id}: {e}")
+
+    async def report(self, stage: str, **fields) -> None:
+        await asyncio.to_thread(self.update, stage, **fields)
+
+    async def increment(self, stage: str, counter: str, amount: int = 1) -> None:
+        await asyncio.to_thread(self.inc, stage, counter, amount)
@@ -0,0 +1,203 @@
+import os
+import re
+import math
+import time
+import asyncio
+import logging
+from typing import List, Optional, Set, Tuple
+
+import httpx
+
+from common.cache import TieredCache, content_key
+from common.ratelimit import BACKGROUND, RateLimiter, UpstreamError, limiter, parse_retry_after
+
+PLACES_ENDPOINT = "https://places.googleapis.com/v1/places:searchText"
+
+FIELD_MASK = ",".join([
+    "places.id",
+    "places.displayName",
+    "places.formattedAddress",
+    "places.location",
+    "places.primaryType",
+    "places.types",
+    "places.businessStatus",
+    "places.googleMapsUri",
+    "places.websiteUri",
+    "places.nationalPhoneNumber",
+    "places.internationalPhoneNumber",
+    "places.rating",
+    "places.userRatingCount"
+])
+
+MAX_PAGES = 3
+PAGE_TOKEN_DELAY = 2  # seconds before a nextPageToken becomes valid
+# Fetch the next page only if the last one produced at least this many
+# place IDs the query's earlier pages had not (0 = always fetch up to MAX_PAGES)
+PLACES_MIN_NEW_IDS = int(os.getenv("PLACES_MIN_NEW_IDS", "1"))
+
+# Persistent result cache (all pages of a query). PLACES_CACHE=false disables it.
+PLACES_CACHE_ENABLED = os.getenv("PLACES_CACHE", "true").lower() == "true"
+PLACES_CACHE_TTL = float(os.getenv("PLACES_CACHE_TTL", str(14 * 24 * 3600)))
+PLACES_CACHE_MAX_ENTRIES = int(os.getenv("PLACES_CACHE_MAX_ENTRIES", "50000"))
+
+# Radius (km) around the user's location that companies must fall within
+SEARCH_RADIUS_KM = float(os.getenv("SEARCH_RADIUS_KM", "50"))
+KM_PER_DEGREE = 111.32
+
+places_cache = TieredCache("places", ttl=PLACES_CACHE_TTL, max_entries=PLACES_CACHE_MAX_ENTRIES) if PLACES_CACHE_ENABLED else None
+
+_spaces = re.compile(r"\s+")
+
+def normalize_query(query: str) -> str:
+    """Case and whitespace only: quotes and word order change what Places returns."""
+    return _spaces.sub(" ", query).strip().lower()
+
+def cache_key(payload: dict, max_pages: int = MAX_PAGES, min_new_ids: int = PLACES_MIN_NEW_IDS) -> str:
+    """Key for a query's result under a pagination rule (page cap, early stop)."""
+    rectangle = payload.get("locationRestriction", {}).get("rectangle")
+    if rectangle:
+        rectangle = {corner: {k: round(v, 6) for k, v in point.items()} for corner, point in rectangle.items()}
+    return content_key(normalize_query(payload["textQuery"]), rectangle, FIELD_MASK, max_pages, min_new_ids)
+
+def bounding_box(lat: float, lng: float, radius_km: float) -> dict:
+    """Smallest lat/lng rectangle containing the circle (Text Search only takes rectangles)."""
+    lat_delta = radius_km / KM_PER_DEGREE
+    lng_delta = min(180.0, radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01)))
+    return {
+        "low": {"latitude": max(lat - lat_delta, -90.0), "longitude": max(lng - lng_delta, -180.0)},
+        "high": {"latitude": min(lat + lat_delta, 90.0), "longitude": min(lng + lng_delta, 180.0)},
+    }
+
+def build_payload(query: str, location: Optional[Tuple[float, float]] = None) -> dict:
+    payload = {
+        "textQuery": query,
+        "maxResultCount": 20
+    }
+
+    if location:
+        lat, lng = location
+
+        # Box around the search circle; the exact radius is applied when
+        # ranking (module2.ranking), since Places only restricts to rectangles
+        payload["locationRestriction"] = {"rectangle": bounding_box(lat, lng, SEARCH_RADIUS_KM)}
+    return payload
+
+class PlacesClient:
+    """
+    Async Google Places (Text Search) client. One pooled httpx client is
+    shared by every query and at most `concurrency` page requests are in
+    flight at once. A slot is held only for the HTTP call itself: a page
+    token is parked until it becomes valid (PAGE_TOKEN_DELAY after it was
+    issued) while the slot serves other queries' pages.
+
+    Pagination stops early when the previous page brought fewer than
+    `min_new_ids` place IDs the query's own earlier pages had not, so a
+    result depends only on the query and is kept in `cache` when given.
+    Every page request is admitted by the process-wide "places" rate
+    limiter (common.ratelimit) and retried there when throttled.
+    Use as `async with PlacesClient(key) as places: ...`.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        concurrency: int = 10,
+        timeout: float = 10,
+        cache: Optional[TieredCache] = places_cache,
+        max_pages: int = MAX_PAGES,
+        min_new_ids: int = PLACES_MIN_NEW_IDS,
+        rate_limiter: Optional[RateLimiter] = None,
+        priority: int = BACKGROUND,
+    ):
+        self.api_key = api_key
+        self.rate_limiter = rate_limiter or limiter("places")
+        self.priority = priority
+        self.cache = cache
+        self.max_pages = max_pages
+        self.min_new_ids = min_new_ids
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.http = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+        )
+        self.stats = {"pages_fetched": 0, "pages_skipped": 0, "parked_seconds": 0.0}
+
+    async def __aenter__(self) -> "PlacesClient":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        await self.http.aclose()
+
+    async def fetch_page(self, headers: dict, payload: dict) -> dict:
+        return await self.rate_limiter.call(lambda: self.post_page(headers, payload), self.priority)
+
+    async def post_page(self, headers: dict, payload: dict) -> dict:
+        async with self.semaphore:
+            response = await self.http.post(PLACES_ENDPOINT, headers=headers, json=payload)
+        self.stats["pages_fetched"] += 1
+        # 429/5xx go back to the limiter (backoff + retry); other errors fail the query
+        if response.status_code == 429 or response.status_code >= 500:
+            raise UpstreamError(response.status_code, parse_retry_after(response.headers))
+        response.raise_for_status()
+        return response.json()
+
+    async def park(self, ready_at: float) -> None:
+        """Wait, without holding a slot, until a page token is usable."""
+        delay = ready_at - time.monotonic()
+        if delay > 0:
+            self.stats["parked_seconds"] += delay
+            await asyncio.sleep(delay)
+
+    async def search(
+        self,
+        query: str,
+        location: Optional[Tuple[float, float]] = None,
+        max_pages: Optional[int] = None,
+    ) -> Tuple[List[dict], str]:
+        """(places, status) with status "OK" or "ERROR"."""
+        headers = {
+            "Content-Type": "application/json",
+            "X-Goog-Api-Key": self.api_key,
+            "X-Goog-FieldMask": FIELD_MASK,
+        }
+        payload = build_payload(query, location)
+        pages = max_pages or self.max_pages
+        key = cache_key(payload, pages, self.min_new_ids) if self.cache else None
+        if key:
+            cached = await asyncio.to_thread(self.cache.get, key)
+            if cached is not None:
+                return cached, "OK"
+
+        all_results = []
+        # Per query, never shared: what another query found must not change this one's pages
+        seen: Set[str] = set()
+        try:
+            for _ in range(pages):
+                data = await self.fetch_page(headers, payload)
+                token_issued = time.monotonic()
+
+                places = data.get("places", [])
+                all_results.extend(places)
+                new_ids = {p["id"] for p in places if p.get("id")} - seen
+                seen.update(new_ids)
+
+                next_page_token = data.get("nextPageToken")
+                if not next_page_token:
+                    break
+                if len(new_ids) < self.min_new_ids:
+                    self.stats["pages_skipped"] += 1
+                    break
+
+                await self.park(token_issued + PAGE_TOKEN_DELAY)
+                payload["pageToken"] = next_page_token
+
+        except Exception as e:
+            logging.error(f"Google Places API Exception | Query: '{query}' | Exception: {e}")
+            return all_results, "ERROR"
+
+        if key:
+            await asyncio.to_thread(self.cache.set, key, all_results)
+        return all_results, "OK"
@@ -0,0 +1,80 @@
+import os
+import re
+import asyncio
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+
+from .places import PlacesClient, normalize_query
+
+# Jaccard similarity of normalized token sets at or above which two search
+# terms are executed as one Places query (1.0 = only exact duplicates)
+TERM_DEDUP_THRESHOLD = float(os.getenv("TERM_DEDUP_THRESHOLD", "0.85"))
+
+_non_word = re.compile(r"[^\w\s]+")
+
+def term_tokens(term: str) -> FrozenSet[str]:
+    """Lowercased tokens without punctuation/quotes, naive plural folding."""
+    tokens = _non_word.sub(" ", term.lower()).split()
+    return frozenset(t[:-1] if len(t) > 3 and t.endswith("s") and not t.endswith("ss") else t for t in tokens)
+
+def jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+class QueryPlanner:
+    """
+    Single execution per distinct search query across every application in
+    a run. Within one application's terms, an exact or near-duplicate
+    (TERM_DEDUP_THRESHOLD on normalized token sets) of an earlier term is
+    answered by that term's query; across applications, identical queries
+    (same normalized text, as cached by PlacesClient) run once and fan back
+    to every application that asked. Neither choice depends on what else
+    the run searched or in what order, so an application's result is a
+    function of its own terms and can be memoized.
+    """
+
+    def __init__(self, places: PlacesClient, location: Optional[Tuple[float, float]], threshold: float = TERM_DEDUP_THRESHOLD):
+        self.places = places
+        self.location = location
+        self.threshold = threshold
+        self.queries: Dict[str, asyncio.Task] = {}
+        self.requesters: Dict[str, Set[str]] = {}
+        self.requested = 0
+
+    def plan(self, terms: List[str]) -> List[str]:
+        """For each term, the term whose query answers it: itself or its closest earlier near-duplicate."""
+        leaders: List[Tuple[str, FrozenSet[str]]] = []
+        planned = []
+        for term in terms:
+            tokens = term_tokens(term)
+            best, best_score = None, self.threshold
+            for leader, leader_tokens in leaders:
+                score = jaccard(tokens, leader_tokens)
+                if score >= best_score and (best is None or score > best_score):
+                    best, best_score = leader, score
+            if best is None:
+                leaders.append((term, tokens))
+                best = term
+            planned.append(best)
+        return planned
+
+    async def search(self, term: str, application: str) -> Tuple[List[dict], str]:
+        """(places, status) as from PlacesClient.search, shared by every identical query."""
+        self.requested += 1
+        key = normalize_query(term)
+        if key not in self.queries:
+            self.queries[key] = asyncio.create_task(self.places.search(term, location=self.location))
+        self.requesters.setdefault(key, set()).add(application)
+        # shield: one requester being cancelled must not cancel the shared query
+        return await asyncio.shield(self.queries[key])
+
+    async def search_terms(self, terms: List[str], application: str) -> List[Tuple[List[dict], str]]:
+        """One (places, status) per term, in order."""
+        return await asyncio.gather(*(self.search(query, application) for query in self.plan(terms)))
+
+    def stats(self) -> Dict[str, int]:
+        executed = len(self.queries)
+        return {
+            "terms_requested": self.requested,
+            "queries_executed": executed,
+            "api_calls_saved": self.requested - executed,
+            "shared_queries": sum(1 for apps in self.requesters.values() if len(apps) > 1),
+        }
@@ -0,0 +1,123 @@
+import os
+import re
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from .places import SEARCH_RADIUS_KM
+from .planner import term_tokens
+
+# Companies kept per application after ranking (0 = keep every match)
+RANK_TOP_K = int(os.getenv("RANK_TOP_K", "50"))
+EARTH_RADIUS_KM = 6371.0088
+
+# Score = weighted sum of components that are each scaled to 0..1
+RANK_WEIGHTS = {
+    "rating": 0.25,      # Bayesian-averaged star rating
+    "popularity": 0.2,   # log of userRatingCount
+    "term_hits": 0.3,    # share of the application's search terms that found the place
+    "type_match": 0.15,  # Places types that look like a supplier or name the application
+    "proximity": 0.1,    # 1 at the user's location, 0 at the radius
+}
+# Ratings with few reviews are pulled towards PRIOR_RATING as if they had
+# PRIOR_COUNT extra reviews at that rating
+PRIOR_RATING = 3.5
+PRIOR_COUNT = 10
+POPULARITY_CAP = 1000  # review count that earns the full popularity score
+
+# Types a B2B buyer is usually after
+SUPPLIER_TYPES = frozenset({
+    "manufacturer", "wholesaler", "supplier", "factory", "industrial", "chemical",
+    "plastic", "distributor", "laboratory", "research", "engineering", "fabricator",
+})
+
+_type_split = re.compile(r"[_\s]+")
+
+def haversine_km(lat: np.ndarray, lng: np.ndarray, origin: Tuple[float, float]) -> np.ndarray:
+    """Great-circle distances (km) from `origin` to every (lat, lng) pair."""
+    lat1, lng1 = np.radians(origin[0]), np.radians(origin[1])
+    lat2, lng2 = np.radians(lat), np.radians(lng)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+def type_matches(place: dict, query_tokens: FrozenSet[str]) -> bool:
+    types = list(place.get("types") or [])
+    if place.get("primaryType"):
+        types.append(place["primaryType"])
+    tokens = {t for type_name in types for t in _type_split.split(type_name.lower()) if t}
+    return bool(tokens & SUPPLIER_TYPES or tokens & query_tokens)
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k best scores, best first (argpartition, then sort only those k)."""
+    if 0 < k < len(scores):
+        best = np.argpartition(-scores, k - 1)[:k]
+    else:
+        best = np.arange(len(scores))
+    return best[np.argsort(-scores[best], kind="stable")]
+
+def rank_places(
+    places: List[dict],
+    term_hits: Dict[str, int],
+    search_terms: Iterable[str],
+    application: str,
+    origin: Optional[Tuple[float, float]] = None,
+    radius_km: float = SEARCH_RADIUS_KM,
+    top_k: int = RANK_TOP_K,
+) -> List[dict]:
+    """
+    Filters `places` (raw Places dicts, unique by id) to `radius_km` around
+    `origin` and returns the `top_k` best scored, best first. Every returned
+    place gets `score`, `termHits` and `distanceKm` (None without an origin).
+    All numeric work is done on NumPy arrays, one row per place.
+    """
+    if not places:
+        return []
+    search_terms = list(search_terms)
+    query_tokens = term_tokens(application).union(*(term_tokens(term) for term in search_terms))
+
+    n = len(places)
+    lat = np.full(n, np.nan)
+    lng = np.full(n, np.nan)
+    rating = np.zeros(n)
+    count = np.zeros(n)
+    hits = np.zeros(n)
+    typed = np.zeros(n)
+    for i, place in enumerate(places):
+        location = place.get("location") or {}
+        if location.get("latitude") is not None and location.get("longitude") is not None:
+            lat[i], lng[i] = location["latitude"], location["longitude"]
+        rating[i] = place.get("rating") or 0.0
+        count[i] = place.get("userRatingCount") or 0
+        hits[i] = term_hits.get(place.get("id"), 1)
+        typed[i] = type_matches(place, query_tokens)
+
+    if origin:
+        distance = haversine_km(lat, lng, origin)
+        # NaN (no location) compares False, so unplaceable companies are dropped too
+        keep = distance <= radius_km
+        proximity = np.clip(1.0 - distance / radius_km, 0.0, 1.0)
+    else:
+        distance = np.full(n, np.nan)
+        keep = np.ones(n, dtype=bool)
+        proximity = np.zeros(n)
+
+    bayesian = (rating * count + PRIOR_RATING * PRIOR_COUNT) / (count + PRIOR_COUNT)
+    components = {
+        "rating": bayesian / 5.0,
+        "popularity": np.minimum(np.log1p(count) / np.log1p(POPULARITY_CAP), 1.0),
+        "term_hits": hits / max(len(search_terms), 1),
+        "type_match": typed,
+        "proximity": proximity,
+    }
+    scores = sum(RANK_WEIGHTS[name] * values for name, values in components.items())
+
+    kept = np.flatnonzero(keep)
+    ranked = []
+    for i in kept[top_k_indices(scores[kept], top_k)]:
+        ranked.append({
+            **places[i],
+            "score": round(float(scores[i]), 4),
+            "termHits": int(hits[i]),
+            "distanceKm": None if np.isnan(distance[i]) else round(float(distance[i]), 2),
+        })
+    return ranked
@@ -0,0 +1,73 @@
+import os
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from common.cache import TieredCache, content_key
+
+# Bump when a stage's output format or logic changes so old entries are ignored
+STAGE_VERSION = 3
+
+# STAGE_CACHE=false recomputes every stage on every run
+STAGE_CACHE_ENABLED = os.getenv("STAGE_CACHE", "true").lower() == "true"
+STAGE_CACHE_TTL = float(os.getenv("STAGE_CACHE_TTL", str(7 * 24 * 3600)))
+STAGE_CACHE_MAX_ENTRIES = int(os.getenv("STAGE_CACHE_MAX_ENTRIES", "50000"))
+
+stage_cache = TieredCache("stages", ttl=STAGE_CACHE_TTL, max_entries=STAGE_CACHE_MAX_ENTRIES) if STAGE_CACHE_ENABLED else None
+
+class StageMemo:
+    """
+    Memoizes pipeline stage outputs by a content hash of their inputs.
+
+    `await memo.run("terms", (model, prompt), compute)` returns the stored
+    output when the same stage saw the same inputs before, and otherwise
+    awaits `compute()` and stores its result (JSON-serialisable) unless
+    `cacheable(result)` says not to, e.g. for errors. Keeps per-run
+    hit/miss counters per stage. `lookup`/`store` are the two halves of
+    `run` for stages that compute several inputs at once.
+    """
+
+    def __init__(self, cache: Optional[TieredCache] = stage_cache):
+        self.cache = cache
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    def key(self, stage: str, inputs: Any) -> str:
+        return content_key(stage, STAGE_VERSION, inputs)
+
+    def count(self, stage: str, outcome: str) -> None:
+        counters = self.stats.setdefault(stage, {"hits": 0, "misses": 0})
+        counters[outcome] += 1
+
+    async def run(
+        self,
+        stage: str,
+        inputs: Any,
+        compute: Callable[[], Awaitable[Any]],
+        cacheable: Callable[[Any], bool] = lambda result: True,
+    ) -> Any:
+        cached = await self.lookup(stage, inputs)
+        if cached is not None:
+            return cached
+        result = await compute()
+        if result is not None and cacheable(result):
+            await self.store(stage, inputs, result)
+        return result
+
+    async def lookup(self, stage: str, inputs: Any) -> Any:
+        """Stored output (counted as a hit) or None (counted as a miss)."""
+        if self.cache:
+            # SQLite lookups are quick but blocking; keep them off the event loop
+            cached = await asyncio.to_thread(self.cache.get, self.key(stage, inputs))
+            if cached is not None:
+                self.count(stage, "hits")
+                return cached
+        self.count(stage, "misses")
+        return None
+
+    async def store(self, stage: str, inputs: Any, result: Any) -> None:
+        if not self.cache:
+            return
+        try:
+            await asyncio.to_thread(self.cache.set, self.key(stage, inputs), result)
+        except (TypeError, ValueError) as e:
+            logging.error(f"Stage '{stage}' output not cacheable: {e}")
@@ -0,0 +1,75 @@
+# module2/worker.py
+
+"""
+Module 2 pipeline worker: `python -m module2.worker`
+
+Claims jobs from the `pipeline_jobs` collection (see module2.jobs) with a
+lease, runs up to WORKER_CONCURRENCY pipelines at once and renews the
+leases while they run. A worker that dies simply stops renewing, and its
+jobs become claimable again once the lease expires.
+"""
+
+import os
+import time
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Tuple
+
+from common.db import close_clients, pool_stats
+from common.indexes import ensure_indexes
+from common.ratelimit import limiter_stats, share_limits
+from .engine import main as run_search_pipeline
+from .jobs import (
+    JOB_LEASE_SECONDS, JobProgress, claim_job,
+    finish_job, get_jobs_collection, renew_lease, worker_name,
+)
+
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "2"))
+WORKER_POLL_SECONDS = float(os.getenv("WORKER_POLL_SECONDS", "5"))
+
+def run_job(collection, job: Dict, worker_id: str) -> None:
+    logging.info(f"Job {job['_id']} started for session {job['session_uuid']} (attempt {job['attempts']})")
+    try:
+        run_search_pipeline(session_uuid=job["session_uuid"], progress=JobProgress(collection, job["_id"]))
+    except Exception as e:
+        logging.exception(f"Job {job['_id']} failed")
+        finish_job(collection, job, worker_id, error=repr(e))
+        return
+    finish_job(collection, job, worker_id)
+    logging.info(f"Job {job['_id']} finished | Mongo pool: {pool_stats()['sync']} | Rate limits: {limiter_stats()}")
+
+def main() -> None:
+    collection = get_jobs_collection()
+    ensure_indexes()
+    # One OpenAI/Places budget across this worker, other workers and the web app
+    share_limits(is_async=False)
+    worker_id = worker_name()
+    running: Dict[str, Tuple[Dict, Future]] = {}
+    renew_every = max(1.0, min(WORKER_POLL_SECONDS, JOB_LEASE_SECONDS / 3))
+    last_renewal = time.monotonic()
+
+    try:
+        with ThreadPoolExecutor(max_workers=WORKER_CONCURRENCY) as executor:
+            print(f"Module 2 worker {worker_id} started (concurrency {WORKER_CONCURRENCY})")
+            while True:
+                for job_id in [job_id for job_id, (_, future) in running.items() if future.done()]:
+                    del running[job_id]
+
+                while len(running) < WORKER_CONCURRENCY:
+                    job = claim_job(collection, worker_id)
+                    if not job:
+                        break
+                    running[job["_id"]] = (job, executor.submit(run_job, collection, job, worker_id))
+
+                if time.monotonic() - last_renewal >= renew_every:
+                    for job_id in running:
+                        if not renew_lease(collection, job_id, worker_id):
+                            logging.warning(f"Lost the lease on job {job_id}")
+                    last_renewal = time.monotonic()
+
+                time.sleep(renew_every)
+    finally:
+        close_clients()
+
+if __name__ == "__main__":
+    main()